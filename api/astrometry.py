@@ -237,6 +237,13 @@ class Client(object):
 
         return stat
 
+    def job_calibration(self, job_id):
+        """
+        :param job_id: id of a solved job
+        :return: calibration dict (ra, dec, radius, pixscale, orientation, parity)
+        """
+        return self.send_request('jobs/%s/calibration' % job_id)
+
     def annotate_data(self,job_id):
         """
         :param job_id: id of job
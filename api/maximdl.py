@@ -39,6 +39,11 @@ class Camera:
 		print "Setting FITS value: {",key,":",value,"}"
 		self.__CAMERA.SetFITSKey(key,value)
 		
+	def reserveFitsKeys(self,keys):
+		# placeholder cards, overwritten in place once the frame is solved
+		for key in keys:
+			self.setFitsKey(key,0)
+		
 	def setBinning(self,binmode):
 		tup = (1,2,3)
 		if binmode in tup:
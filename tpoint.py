@@ -1,17 +1,11 @@
-# import API libraries:
-try:
-	from api import skyx, maximdl
-except:
-	print "Could not import API libraries"
-# import utilities:
-from utility import sphere, dispatch, plot, geometry
-from utility.tsp import tsp
-# other dependencies:
-import numpy as np
-import ephem
 # python defaults:
-import os,json,hashlib
+import time
+STARTED = time.time()
+import os,sys,json,hashlib,argparse
 from datetime import datetime
+from utility import timing
+# API libraries, numpy, ephem, matplotlib and watchdog are imported by the
+# routines that need them, so the command line starts quickly.
 
 def Survey(P):
 	'''
@@ -27,16 +21,18 @@ def Survey(P):
   	  to know not only rough pointing (speeds up plate solve), but also lat/lon and timestamp
   	  for producing a tpoint file
 	'''
+	from api import skyx, maximdl
+	from utility import geometry, jobs, cache, fits
 	# check if output directory exists:
 	print "-------------------------------------"
 	print " Verifying output directory...."
-	if os.path.isdir(P['Save_Directory']):
+	if os.path.isdir(P['files']['fit_directory']):
 		print "Storing FITS files in:",P['files']['fit_directory']
 	else:
 		print "Directory does not exist:",P['files']['fit_directory']
 		print "Attempting to create directory..."
-		os.makedirs(P['Save_Directory'])
-		if os.path.isdir(P['Save_Directory']):
+		os.makedirs(P['files']['fit_directory'])
+		if os.path.isdir(P['files']['fit_directory']):
 			print "Done."
 		else:
 			print "Could not create directory.  Exiting."
@@ -51,13 +47,20 @@ def Survey(P):
 	print " Generating survey grid...."
 	az,el = UniformSearchGrid(P)
 	az,el = ShortestPath(az,el)
+	live = None
+	if P.get('plot',{}).get('live'):
+		from utility import plot
+		live = plot.LivePlot2D(az,el,P)
 	print "-------------------------------------"
 	print " Connecting to TheSkyX..."
 	scope = skyx.sky6RASCOMTele()
 	scope.Connect()
+	timing.instrument(scope,('SlewToAzAlt','GetRaDec'),'skyx')
 	print "-------------------------------------"
 	print " Connecting to MaximDL..."
 	camera = maximdl.Camera()
+	timing.instrument(camera,('expose','saveImage','setFitsKey','reserveFitsKeys'),'maximdl')
+	queue = jobs.JobQueue(cache.default_path(P))
 	print "-------------------------------------"
 	print " Initiating Survey..."
 	count = 0
@@ -79,6 +82,9 @@ def Survey(P):
 		# -------------------------------------------
 		# store session key
 		camera.setFitsKey("tp_key",session_key)
+		# store commanded az/el
+		camera.setFitsKey("tp_az",az1)
+		camera.setFitsKey("tp_el",el1)
 		ra,dec = scope.GetRaDec()
 		# store ra/dec
 		camera.setFitsKey("tp_ra",ra)
@@ -90,16 +96,17 @@ def Survey(P):
 		camera.setFitsKey("tp_lat",P['location']['lat'])
 		camera.setFitsKey("tp_lon",P['location']['lon'])
 		# store sidereal time
-		camera.setFitsKey("tp_LST",compute_sidereal_time(P['location']['lon']))
+		camera.setFitsKey("tp_LST",geometry.compute_sidereal_time(P['location']['lon'],t=datetime.utcnow()))
+		# reserve room for the plate solution
+		camera.reserveFitsKeys(fits.SOLUTION_KEYS)
 		# Save Exposure
 		filename = session_key + "_" + str(count) + ".fits"
-		# save_dir = "C:\\Users\\Dave\\Desktop\\tpoint"
-		save_dir = P['files']['fit_directory']
-
-		# need to change this to be platform independent:
-
-		save_path = save_dir+"\\"+filename
+		save_path = os.path.join(P['files']['fit_directory'],filename)
 		camera.saveImage(save_path)
+		# let the solver know about it, even if it isn't running yet
+		queue.add(save_path,session_key)
+		if live:
+			live.update(az1,el1)
 	print "-------------------------------------"
 	print " Survey Complete!"
 
@@ -107,14 +114,87 @@ def Solve(P):
 	'''
 	Watch directory of FITs files, solve them.
 	'''
-	w = dispatch.Watcher(P)
+	from utility import solver, dispatch, jobs, cache, index, fits, mount_model
+	def report(job):
+		counts = manager.progress()
+		print job.state.capitalize()+":",job.path,"(%d of %d done)" % (counts['success']+counts['failure'],counts['total'])
+	model = mount_model.RecursiveModel()
+	def track(job):
+		# update the mount model as each frame solves
+		if job.state != solver.SUCCESS:
+			return
+		row = index.record(job.path,fits.read_header(job.path,fits.TPOINT_KEYS),job.calibration)
+		model.update(mount_model.from_index(index.to_columns([row])))
+		print "Mount model:",model.summary()
+		if model.converged():
+			print "Mount model has converged, the survey can be stopped."
+	manager = solver.SolveManager(P,callback=StoreSolution)
+	manager.add_callback(report)
+	manager.add_callback(track)
+	manager.add_callback(index.SessionIndex(index.default_path(P)).solved)
+	w = dispatch.Watcher(P,manager.solve,jobs.JobQueue(cache.default_path(P)))
 	w.run()
+	manager.close()
+
+def Reprocess(P,directory=None,session=None):
+	'''
+	Solve an existing archive of FITs files, optionally only one session.
+	'''
+	from utility import solver, jobs, cache, index, batch
+	manager = solver.SolveManager(P,callback=StoreSolution)
+	manager.add_callback(index.SessionIndex(index.default_path(P)).solved)
+	queue = jobs.JobQueue(cache.default_path(P))
+	batch.solve_archive(P,manager,directory,session,queue)
+	manager.close()
+
+def StoreSolution(job):
+	'''
+	Write a finished solve back into the frame's FITs header.
+	'''
+	from utility import solver, fits
+	if job.state == solver.FAILURE and job.error != 'no solution':
+		return
+	fits.write_solution(job.path,job.calibration)
+
+def Index(P,directory=None,session=None):
+	'''
+	Rebuild the session index from the FITs headers.
+	'''
+	from utility import index
+	if directory is None:
+		directory = P['files']['fit_directory']
+	n = index.SessionIndex(index.default_path(P)).build(directory,session)
+	print "Indexed",n,"frames"
+
+def Residuals(P,sessions=None,coords='azel',save_path=None):
+	'''
+	Binned map of pointing residuals from the session index.
+	'''
+	from utility import index, plot
+	table = index.SessionIndex(index.default_path(P)).load(sessions)
+	plot.ResidualMap(table,P,coords,save_path=save_path)
+
+def Export(P,path=None,sessions=None,from_fits=False):
+	'''
+	Compile a tpoint data file from the solved frames, from the session index
+	or straight from the FITs headers.
+	'''
+	from utility import index, export
+	if path is None:
+		path = os.path.join(P['files']['fit_directory'],'tpoint.dat')
+	if from_fits:
+		n = export.export_fits(path,P['files']['fit_directory'],sessions)
+	else:
+		n = export.export_index(path,index.default_path(P),sessions)
+	print "Wrote",n,"sessions to",path
 
+@timing.timed('tpoint.ShortestPath')
 def ShortestPath(az,el):
 	'''
 	Given az/el pairs (deg), determine the shortest path through the grid.
 	- Try to avoid meridian  flip
 	'''
+	from utility.tsp import tsp
 	# Split indeces into east/west data
 	east = []
 	west = []
@@ -140,10 +220,12 @@ def ShortestPath(az,el):
 
 	return a,e
 
+@timing.timed('tpoint.ScrubGridAzEl')
 def ScrubGridAzEl(P,Az,El):
 	'''
 	This filters az/el pairs based on paramaters in the dictionary P
 	'''
+	from utility import geometry
 	Az_Scrub = []
 	El_Scrub = []
 	for az,el in zip(Az,El):
@@ -167,6 +249,7 @@ def ScrubGridAzEl(P,Az,El):
 		El_Scrub.append(el)
 	return Az_Scrub,El_Scrub
 
+@timing.timed('tpoint.RandomSearchGrid')
 def RandomSearchGrid(P):
 	'''
 	Produce a survey grid from randomly sampled points.
@@ -176,6 +259,7 @@ def RandomSearchGrid(P):
 	theta = 2*pi*U = Azimuth*pi/180
 	phi = acos(2*V-1)= (90 - Elevation)*pi/180
 	'''
+	import numpy as np
 	num_samples = 41253/P['survey']['area']
 	U = np.random.rand(num_samples/4)
 	V = np.random.rand(num_samples)
@@ -186,11 +270,13 @@ def RandomSearchGrid(P):
 	az,el = ScrubGridAzEl(P,az,el)
 	return az,el
 
+@timing.timed('tpoint.UniformSearchGrid')
 def UniformSearchGrid(P):
 	'''
 	Produce a search grid with specified area per grid point.
 	This results in a regular distribution.
 	'''
+	from utility import sphere
 	# points:
 	V,Phi = sphere.area_regular_points(P['survey']['area'])
 	# create az/el:
@@ -202,6 +288,7 @@ def UniformSearchGrid(P):
 	return az,el
 
 def Test(P):
+	from utility import plot, report
 	print '--------------------------------------------'
 	print '    Demo of scripted T-Point Calibration'
 	print '--------------------------------------------'
@@ -212,12 +299,8 @@ def Test(P):
 	az,el = UniformSearchGrid(P)
 	az,el = ShortestPath(az,el)
 	if save_plots:
-		# Survey plots:
-		plot.Plot2D(az,el,P,'none','docs/images/survey_2D.png')
-		plot.Plot3D(az,el,P,'none','docs/images/survey_3D.png')
-		# TSP plots:
-		plot.Plot2D(az,el,P,'-','docs/images/tsp_2D.png')
-		plot.Plot3D(az,el,P,'-','docs/images/tsp_3D.png')
+		# Survey and TSP plots, rendered in parallel:
+		report.render_all(report.survey_figures(P,az,el,'docs/images'))
 
 	else:
 		plot.Plot2D(az,el,P)
@@ -225,9 +308,118 @@ def Test(P):
 		plot.Plot2D(az,el,P,'-')
 		plot.Plot3D(az,el,P,'-')
 
+def Plan(P,random=False,plot_directory=None):
+	'''
+	Print the survey route, one "az el" pair per line, optionally saving
+	the survey figures.
+	'''
+	if random:
+		az,el = RandomSearchGrid(P)
+	else:
+		az,el = UniformSearchGrid(P)
+	az,el = ShortestPath(az,el)
+	for az1,el1 in zip(az,el):
+		print "%.4f %.4f" % (az1,el1)
+	if plot_directory:
+		from utility import report
+		report.render_all(report.survey_figures(P,az,el,plot_directory))
+	return az,el
+
+def Model(P,sessions=None,tpoint_file=None,select=False,robust='tukey'):
+	'''
+	Fit a mount model to a tpoint file, or to the solved frames in the
+	session index (flagging the frames it rejects).
+	'''
+	from utility import index, mount_model
+	if tpoint_file:
+		data = mount_model.parse_tpoint(tpoint_file)
+	else:
+		session_index = index.SessionIndex(index.default_path(P))
+	terms = mount_model.DEFAULT_TERMS
+	if select:
+		from utility import model_select
+		if not tpoint_file:
+			data = mount_model.from_index(session_index.load(sessions))
+		terms = model_select.select_terms(data)['terms']
+	if tpoint_file:
+		model = mount_model.solve_tpoint(data,terms,robust=robust)
+	else:
+		model = mount_model.fit_index(session_index,sessions,terms,robust)
+	print mount_model.report(model)
+	return model
+
+def Bench(P,names=None,repeat=3,full=False,history='bench_history.jsonl',threshold=1.25,save=True):
+	'''
+	Run the benchmarks, compare them with the history file and append this
+	run.  Returns the names of any that regressed.
+	'''
+	from utility import bench
+	def progress(name,seconds):
+		print >> sys.stderr, "%-34s %10.4f" % (name,seconds)
+	results = {}
+	if not names or any(bench.selected('startup.cli',[n]) for n in names):
+		results.update(bench.startup(os.path.abspath(__file__)))
+	results.update(bench.run(names,repeat,full,progress))
+	rows = bench.compare(results,bench.load_history(history),threshold)
+	print bench.format_rows(rows)
+	if save:
+		bench.record(history,results)
+	return [r[0] for r in rows if r[4]]
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Automated telescope pointing surveys and mount models.')
+	parser.add_argument('-c','--config',default='test_input.json',help='survey configuration (json)')
+	parser.add_argument('--startup',action='store_true',help='print the time taken to reach the command')
+	commands = parser.add_subparsers(dest='command')
+	plan = commands.add_parser('plan',help='print the survey route')
+	plan.add_argument('--random',action='store_true',help='random instead of uniform grid')
+	plan.add_argument('--plots',metavar='DIR',help='also save the survey figures to DIR')
+	commands.add_parser('survey',help='run the survey (TheSkyX + MaxIm DL)')
+	solve = commands.add_parser('solve',help='plate solve frames as they arrive')
+	solve.add_argument('--archive',metavar='DIR',help='solve an existing directory instead of watching')
+	solve.add_argument('--session',help='only this session (with --archive)')
+	model = commands.add_parser('model',help='fit a mount model')
+	model.add_argument('--session',action='append',help='session key (repeatable, default all)')
+	model.add_argument('--tpoint',metavar='FILE',help='fit a tpoint data file instead of the index')
+	model.add_argument('--select',action='store_true',help='choose terms automatically')
+	model.add_argument('--index',action='store_true',help='rebuild the index from the FITs headers first')
+	export = commands.add_parser('export',help='write a tpoint data file')
+	export.add_argument('-o','--output',help='default tpoint.dat in the FITs directory')
+	export.add_argument('--session',action='append',help='session key (repeatable, default all)')
+	export.add_argument('--from-fits',action='store_true',help='read the FITs headers instead of the index')
+	bench = commands.add_parser('bench',help='run the benchmarks')
+	bench.add_argument('names',nargs='*',help='only benchmarks starting with these names')
+	bench.add_argument('--repeat',type=int,default=3)
+	bench.add_argument('--full',action='store_true',help='include the slowest workloads')
+	bench.add_argument('--history',default='bench_history.jsonl',help='results history (json lines)')
+	bench.add_argument('--threshold',type=float,default=1.25,help='slowdown ratio counted as a regression')
+	bench.add_argument('--no-save',action='store_true',help="don't add this run to the history")
+	args = parser.parse_args(argv)
+
+	P = json.load(open(args.config))
+	if args.startup:
+		print >> sys.stderr, "startup: %.3f s" % (time.time()-STARTED)
+	def command():
+		if args.command == 'plan':
+			Plan(P,args.random,args.plots)
+		elif args.command == 'survey':
+			Survey(P)
+		elif args.command == 'solve':
+			if args.archive:
+				Reprocess(P,args.archive,args.session)
+			else:
+				Solve(P)
+		elif args.command == 'model':
+			if args.index:
+				Index(P)
+			Model(P,args.session,args.tpoint,args.select)
+		elif args.command == 'export':
+			Export(P,args.output,args.session,args.from_fits)
+		elif args.command == 'bench':
+			return Bench(P,args.names,args.repeat,args.full,args.history,args.threshold,not args.no_save)
+	if timing.run(args.command,command,P):
+		return 1
+	return 0
+
 if __name__ == "__main__":
-	# load survey config fromt he default file:
-	P = json.load(open('test_input.json'))
-	Test(P)
-	# Survey(P)
-	# Solve(P)
\ No newline at end of file
+	sys.exit(main())
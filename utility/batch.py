@@ -0,0 +1,126 @@
+import time
+import numpy as np
+import fits
+import jobs
+
+'''
+Re-solve FITS archives from past sessions.
+
+Frames are found by walking a directory tree, filtered on their tp_key
+session header, ordered so the frames covering the most sky go first and
+pushed through a SolveManager.  Progress is kept in the durable job table,
+so an interrupted run picks up where it stopped.
+'''
+
+def scan(directory,session=None):
+	'''
+	Return [(path,header)] for every tpoint frame under directory that
+	has a recorded pointing, optionally only those from one session (tp_key).
+	'''
+	return [(path,header) for path,header in fits.scan(directory,session=session)
+		if 'TP_RA' in header and 'TP_DEC' in header]
+
+def coverage_order(ra,dec):
+	'''
+	Order points so each one is as far as possible from those before it
+	(farthest point sampling).  Any prefix of the order spreads over the
+	widest possible patch of sky.  ra/dec in degrees, returns indices.
+	'''
+	ra = np.deg2rad(np.asarray(ra,dtype=float))
+	dec = np.deg2rad(np.asarray(dec,dtype=float))
+	n = len(ra)
+	if n == 0:
+		return []
+	v = np.column_stack((np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)))
+	# start from the point farthest from the mean direction
+	order = [int(np.argmin(v.dot(v.mean(axis=0))))]
+	# closeness to the chosen set, as the largest dot product
+	closest = v.dot(v[order[0]])
+	closest[order[0]] = np.inf
+	for i in range(1,n):
+		nxt = int(np.argmin(closest))
+		order.append(nxt)
+		closest = np.maximum(closest,v.dot(v[nxt]))
+		closest[nxt] = np.inf
+	return order
+
+def solve_archive(P,manager,directory=None,session=None,queue=None,report_every=10):
+	'''
+	Solve every frame under directory (default: the FITS directory) with
+	the given SolveManager.  Frames already done in the job table are
+	skipped.  Returns a summary dict with throughput and failed paths.
+
+	Frames are handed to the manager only as upload slots free up and each
+	is claimed in the job table just before it is submitted, so after a
+	crash at most max_in_flight frames are left running.  Those are put
+	back to pending when the next run starts, so don't run this next to a
+	live watcher sharing the same job table.
+	'''
+	if directory is None:
+		directory = P['files']['fit_directory']
+	if queue is not None:
+		n = queue.recover()
+		if n:
+			print "Resuming",n,"interrupted frames"
+	print "Scanning",directory,"..."
+	frames = scan(directory,session)
+	if queue is not None:
+		for path,header in frames:
+			queue.add(path,header['TP_KEY'])
+		todo = set(queue.select(jobs.PENDING,session))
+		frames = [f for f in frames if f[0] in todo]
+	print "Found",len(frames),"frames to solve"
+	order = coverage_order(
+		[float(h['TP_RA'])*15 for p,h in frames],
+		[float(h['TP_DEC']) for p,h in frames])
+	# this run's frames, as the manager may be shared with other callers
+	submitted = set()
+	done = []
+	def finished(job):
+		if job.path not in submitted:
+			return
+		done.append(job)
+		if queue is not None:
+			queue.finish(job.path,job.error)
+	def report():
+		failures = sum(1 for job in done if job.state == 'failure')
+		elapsed = time.time()-start
+		print "%d of %d submitted frames done, %d failed, %.1f frames/min" % (
+			len(done),len(submitted),failures,60*len(done)/elapsed)
+	manager.add_callback(finished)
+	start = time.time()
+	last_report = start
+	try:
+		for i in order:
+			path,header = frames[i]
+			while not manager.wait_capacity(report_every):
+				report()
+				last_report = time.time()
+			if time.time()-last_report >= report_every:
+				report()
+				last_report = time.time()
+			if queue is not None and not queue.claim(path):
+				# finished meanwhile, or claimed by another worker
+				continue
+			submitted.add(path)
+			manager.submit(path,
+				center_ra=float(header['TP_RA'])*15,
+				center_dec=float(header['TP_DEC']),
+				radius=P['camera']['fov'])
+		while not manager.join(report_every):
+			report()
+	finally:
+		manager.remove_callback(finished)
+	elapsed = time.time()-start
+	failed = [(job.path,job.error) for job in done if job.state == 'failure']
+	summary = {
+		'frames':len(submitted),
+		'solved':len(done)-len(failed),
+		'failed':failed,
+		'seconds':elapsed,
+		'rate':60*len(submitted)/elapsed if elapsed else 0}
+	print "Solved %d of %d frames in %.0f s (%.1f frames/min), %d failed" % (
+		summary['solved'],summary['frames'],elapsed,summary['rate'],len(failed))
+	for path,error in failed:
+		print "  failed:",path,error
+	return summary
@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import subprocess
+import threading
+from datetime import datetime, timedelta
+from StringIO import StringIO
+import numpy as np
+
+'''
+Benchmarks for the hot paths: survey grids, coordinate transforms, the
+route (TSP) search, the plate solve pipeline and mount model fitting.
+
+Every workload is built from a fixed seed, so timings are comparable from
+run to run.  Plate solving runs against LocalClient, an in-process stand-in
+for the astrometry.net API, so only our own scheduling is measured.
+Results are appended to a JSON lines history file and each new timing is
+compared with the median of recent runs on the same host.
+'''
+
+SEED = 0
+# site and survey settings shared by the workloads, as in test_input.json
+SITE = {
+	'location':{'lat':40,'lon':-84},
+	'survey':{'area':6,'buffers':{'meridian':4,'pole':20},'masks':{'include':{'elevation':[15,90]}}}}
+# modules the command line avoids importing up front
+HEAVY_IMPORTS = ('numpy','ephem','matplotlib.pyplot','watchdog.observers')
+
+class LocalClient(object):
+	'''
+	astrometry.Client stand-in: submissions get a job on the first status
+	request and solve on the second.
+	'''
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._polls = {}
+
+	def upload(self,path,**kwargs):
+		with self._lock:
+			subid = len(self._polls)+1
+			self._polls[subid] = 0
+		return {'status':'success','subid':subid}
+
+	def sub_status(self,subid,justdict=True):
+		return {'jobs':[subid]}
+
+	def job_status(self,job_id,justdict=True):
+		with self._lock:
+			self._polls[job_id] += 1
+			return {'status':'success' if self._polls[job_id] > 1 else 'solving'}
+
+	def job_calibration(self,job_id):
+		return {'ra':job_id % 360,'dec':45.0,'orientation':0.0,'pixscale':1.0}
+
+def synthetic(n,seed=SEED,lat=40.0,noise=2.0):
+	'''
+	parse_tpoint style observations of a mount with a known model.
+	'''
+	import mount_model
+	r = np.random.RandomState(seed)
+	ha = r.uniform(-90,90,n)
+	dec = r.uniform(-30,80,n)
+	truth = {'terms':['IH','ID','NP','MA','ME','TF'],'values':np.array([120.0,-45.0,15.0,60.0,-40.0,10.0])}
+	dh,dd = mount_model.evaluate(truth,ha,dec,lat)
+	dh = dh+r.normal(0,noise,n)
+	dd = dd+r.normal(0,noise,n)
+	lst = r.uniform(0,24,n)
+	return {
+		'ha_obs':ha,
+		'dec_obs':dec,
+		'ha_cmd':ha+dh/np.cos(np.deg2rad(dec))/3600,
+		'dec_cmd':dec+dd/3600,
+		'lst':lst,
+		'pier':np.zeros(n,dtype=np.int8),
+		'lat':np.full(n,lat)}
+
+def _tpoint_text(n,seed=SEED):
+	'''
+	A tpoint data file of n observations, for the parser benchmark.
+	'''
+	import export
+	data = synthetic(n,seed)
+	table = {
+		'lst':data['lst']*15,
+		'solved_ra':data['lst']*15-data['ha_obs'],
+		'solved_dec':data['dec_obs'],
+		'ra':data['lst']*15-data['ha_cmd'],
+		'dec':data['dec_cmd'],
+		'lat':data['lat'],
+		'utc':np.zeros(n),
+		'rejected':np.zeros(n,dtype=bool)}
+	return export.block(table,'benchmark')
+
+# each setup builds its inputs and returns the function to time
+def _grid(area):
+	'''
+	The full survey grid: sphere points scrubbed against the site limits.
+	'''
+	import tpoint
+	P = dict(SITE,survey=dict(SITE['survey'],area=area))
+	return lambda: tpoint.UniformSearchGrid(P)
+
+def _radec2azel(n):
+	import geometry
+	r = np.random.RandomState(SEED)
+	ra,dec = r.uniform(0,360,n),r.uniform(-30,90,n)
+	t = datetime(2018,2,4,3,0)
+	return lambda: geometry.RaDec2AzEl_many(t,ra,dec,40,-84)
+
+def _radec2azel_scalar(n):
+	import geometry
+	r = np.random.RandomState(SEED)
+	ra,dec = r.uniform(0,360,n),r.uniform(-30,90,n)
+	t = datetime(2018,2,4,3,0)
+	return lambda: [geometry.RaDec2AzEl(t,a,d,40,-84) for a,d in zip(ra,dec)]
+
+def _meridian_rotate(n):
+	import geometry
+	r = np.random.RandomState(SEED)
+	az,el,theta = r.uniform(0,360,n),r.uniform(0,90,n),r.uniform(-10,10,n)
+	return lambda: geometry.meridian_rotate_many(az,el,theta)
+
+def _visibility(n):
+	import visibility
+	r = np.random.RandomState(SEED)
+	ra,dec = r.uniform(0,360,n),r.uniform(-30,90,n)
+	start = datetime(2018,2,4,23,0)
+	return lambda: visibility.Visibility(SITE,ra,dec,start,start+timedelta(hours=12))
+
+def _tsp(n):
+	'''
+	One route: distance matrix, nearest neighbour tour and local search
+	(tsp.tsp repeats the last two from 100 starting points).
+	'''
+	import tsp
+	r = random.Random(SEED)
+	points = [(r.uniform(0,360),r.uniform(15,90)) for i in range(n)]
+	def run():
+		n,D = tsp.mk_matrix(points,tsp.GreatCircleDelta)
+		tour = tsp.nearest_neighbor(n,0,D)
+		tsp.localsearch(tour,tsp.length(tour,D),D)
+	return run
+
+def _solve(n):
+	import solver
+	P = {'astrometry':{'api':{},'solver':{'max_in_flight':32,'poll_min':0.01,'poll_max':0.05}}}
+	def run():
+		manager = solver.SolveManager(P,client=LocalClient(),cache=False)
+		for i in range(n):
+			manager.submit('frame_%d.fits' % i)
+		manager.join()
+		manager.close()
+	return run
+
+def _parse(n):
+	import mount_model
+	text = _tpoint_text(n)
+	return lambda: mount_model.parse_tpoint(StringIO(text))
+
+def _fit(n,robust=None):
+	import mount_model
+	data = synthetic(n)
+	return lambda: mount_model.solve_tpoint(data,robust=robust)
+
+def _recursive(n):
+	import mount_model
+	data = synthetic(n)
+	rows = [dict((k,v[i:i+1]) for k,v in data.items()) for i in range(n)]
+	def run():
+		model = mount_model.RecursiveModel()
+		for row in rows:
+			model.update(row)
+	return run
+
+def _select(n):
+	import model_select
+	data = synthetic(n)
+	return lambda: model_select.select_terms(data,processes=1)
+
+def workloads(full=False):
+	'''
+	(name,setup) pairs in run order.  full adds a 2000 point route; its
+	distance matrix is a dict of 4 million pairs (about half a gigabyte and
+	half a minute), so larger routes are out of reach.
+	'''
+	tsp_sizes = (100,1000,2000) if full else (100,1000)
+	return ([('grid.area%g' % a,lambda a=a: _grid(a)) for a in (2,6,20)]+
+		[('transform.radec2azel.100k',lambda: _radec2azel(100000)),
+		('transform.radec2azel_scalar.1k',lambda: _radec2azel_scalar(1000)),
+		('transform.meridian_rotate.100k',lambda: _meridian_rotate(100000)),
+		('visibility.build.1k',lambda: _visibility(1000))]+
+		[('tsp.%d' % n,lambda n=n: _tsp(n)) for n in tsp_sizes]+
+		[('solve.pipeline.500',lambda: _solve(500)),
+		('model.parse.100k',lambda: _parse(100000)),
+		('model.fit.10k',lambda: _fit(10000)),
+		('model.fit_tukey.10k',lambda: _fit(10000,'tukey')),
+		('model.recursive.1k',lambda: _recursive(1000)),
+		('model.select.2k',lambda: _select(2000))])
+
+def timeit(f,repeat=3):
+	'''
+	Best of repeat wall clock timings, seconds.
+	'''
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		f()
+		elapsed = time.time()-start
+		best = elapsed if best is None else min(best,elapsed)
+	return best
+
+def startup(script,repeat=5):
+	'''
+	Interpreter start, command line start and each heavy import, timed in
+	fresh processes.
+	'''
+	null = open(os.devnull,'w')
+	call = lambda args: subprocess.call([sys.executable]+args,stdout=null,stderr=null)
+	def run(args):
+		if call(args) != 0:
+			return None
+		return timeit(lambda: call(args),repeat)
+	try:
+		results = {
+			'startup.python':run(['-c','pass']),
+			'startup.cli':run([script,'--help'])}
+		for module in HEAVY_IMPORTS:
+			results['startup.import.'+module] = run(['-c','import '+module])
+	finally:
+		null.close()
+	return dict((k,v) for k,v in results.items() if v is not None)
+
+def selected(name,names):
+	return any(name == n or name.startswith(n+'.') for n in names)
+
+def run(names=None,repeat=3,full=False,report=None):
+	'''
+	Time the workloads, or only those selected by names: 'tsp' selects
+	every tsp.* workload, 'tsp.100' just that one.
+	report(name,seconds) is called as each one finishes.
+	'''
+	results = {}
+	for name,setup in workloads(full):
+		if names and not selected(name,names):
+			continue
+		results[name] = timeit(setup(),repeat)
+		if report:
+			report(name,results[name])
+	return results
+
+def load_history(path):
+	if not os.path.exists(path):
+		return []
+	with open(path) as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+def record(path,results):
+	'''
+	Append one run to the history file.
+	'''
+	entry = {
+		'time':datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+		'host':platform.node(),
+		'python':platform.python_version(),
+		'results':results}
+	with open(path,'a') as f:
+		f.write(json.dumps(entry,sort_keys=True)+'\n')
+	return entry
+
+def compare(results,history,threshold=1.25,window=5):
+	'''
+	Compare timings with the median of the last window runs on this host.
+	Returns (name,seconds,baseline,ratio,regressed) rows; baseline is None
+	for workloads without history.
+	'''
+	host = platform.node()
+	rows = []
+	for name in sorted(results):
+		past = [h['results'][name] for h in history if h.get('host') == host and name in h['results']][-window:]
+		if not past:
+			rows.append((name,results[name],None,None,False))
+			continue
+		baseline = float(np.median(past))
+		ratio = results[name]/baseline if baseline > 0 else 1.0
+		rows.append((name,results[name],baseline,ratio,ratio > threshold))
+	return rows
+
+def format_rows(rows):
+	lines = ['%-34s %10s %10s %8s' % ('benchmark','seconds','baseline','ratio')]
+	for name,seconds,baseline,ratio,regressed in rows:
+		if baseline is None:
+			lines.append('%-34s %10.4f %10s %8s' % (name,seconds,'-','-'))
+		else:
+			lines.append('%-34s %10.4f %10.4f %8.2f%s' % (name,seconds,baseline,ratio,'  REGRESSION' if regressed else ''))
+	return '\n'.join(lines)
@@ -0,0 +1,151 @@
+import math
+import numpy as np
+import mount_model
+import parallel
+
+'''
+Resampling estimates of mount model uncertainty.
+
+Formal least squares sigmas assume independent residuals, which pointing
+residuals rarely are: neighbouring parts of the sky share flexure and
+optics.  Here the fit is repeated on resampled observations (bootstrap)
+or with groups left out (jackknife), optionally resampling whole patches
+of sky at a time.  Replicates run on a process pool; the design matrix
+lives in shared memory and each replicate only changes the weights.
+'''
+
+# per process state, set by _init
+_shared = {}
+
+def _init(A,y,groups):
+	_shared['A'] = parallel.attach(A)
+	_shared['y'] = parallel.attach(y)
+	_shared['groups'] = parallel.attach(groups).astype(int)
+
+def _fit(weights):
+	A,y = _shared['A'],_shared['y']
+	w = np.concatenate((weights,weights))
+	Aw = A*w[:,None]
+	return np.linalg.lstsq(np.dot(Aw.T,A),np.dot(Aw.T,y),rcond=1e-12)[0]
+
+def _bootstrap(task):
+	'''
+	Fit count replicates, each drawing groups with replacement.
+	'''
+	seed,count = task
+	groups = _shared['groups']
+	ngroups = groups.max()+1
+	r = np.random.RandomState(seed)
+	out = []
+	for i in range(count):
+		draws = np.bincount(r.randint(0,ngroups,ngroups),minlength=ngroups)
+		out.append(_fit(draws[groups].astype(float)))
+	return np.array(out)
+
+def _jackknife(task):
+	'''
+	Fit one replicate per group, each leaving that group out.
+	'''
+	first,count = task
+	groups = _shared['groups']
+	return np.array([_fit((groups != g).astype(float)) for g in range(first,first+count)])
+
+def sky_groups(data,block=None):
+	'''
+	Group observations by block x block degree cells of hour angle/Dec,
+	or one group per observation without a block size.
+	'''
+	n = len(data['ha_obs'])
+	if not block:
+		return np.arange(n)
+	cell = (np.floor((np.asarray(data['ha_obs'])+180)/block)*1000+
+		np.floor((np.asarray(data['dec_obs'])+90)/block))
+	return np.unique(cell,return_inverse=True)[1]
+
+def _z(level):
+	'''
+	Two sided normal quantile for a confidence level, by bisection on erf.
+	'''
+	lo,hi = 0.0,10.0
+	for i in range(60):
+		mid = (lo+hi)/2
+		if math.erf(mid/math.sqrt(2)) < level:
+			lo = mid
+		else:
+			hi = mid
+	return lo
+
+def _tasks(total,size):
+	return [(start,min(size,total-start)) for start in range(0,total,size)]
+
+def resample(data,terms=mount_model.DEFAULT_TERMS,replicates=1000,method='bootstrap',
+	block=None,level=0.95,processes=None,seed=0,map_step=10.0):
+	'''
+	Estimate mount model term uncertainties by resampling.
+
+	    data: parse_tpoint/from_index style observations
+	replicates: number of bootstrap fits (jackknife uses one per group)
+	  method: 'bootstrap' or 'jackknife'
+	   block: resample whole block x block degree sky cells instead of
+	          single observations
+	   level: confidence level of the reported intervals
+	map_step: grid spacing (deg) of the uncertainty sky map
+
+	Returns a dict with the full fit 'values', replicate 'samples',
+	'sigmas', 'lower'/'upper' confidence limits (arcsec) and 'map', the
+	predicted pointing uncertainty (sky arcsec) over hour angle/Dec.
+	'''
+	terms = list(terms)
+	lat = np.mean(data['lat'])
+	A = mount_model.design_matrix(terms,data['ha_obs'],data['dec_obs'],data['lat'])
+	y = mount_model.offsets(data)
+	groups = sky_groups(data,block)
+	ngroups = groups.max()+1
+	handles = (parallel.share(A),parallel.share(y),parallel.share(groups))
+	n = parallel.processes(processes)
+	if method == 'jackknife':
+		work,tasks = _jackknife,_tasks(ngroups,max(ngroups//(4*n),1))
+	else:
+		r = np.random.RandomState(seed)
+		work = _bootstrap
+		tasks = [(r.randint(2**31),count) for start,count in _tasks(replicates,max(replicates//(4*n),1))]
+	if n > 1:
+		workers = parallel.pool(n,_init,handles)
+		try:
+			samples = np.concatenate(workers.map(work,tasks))
+		finally:
+			workers.terminate()
+	else:
+		_init(*handles)
+		samples = np.concatenate(map(work,tasks))
+	full = mount_model.solve_tpoint(data,terms)
+	if method == 'jackknife':
+		sigmas = np.sqrt((ngroups-1.0)/ngroups*((samples-samples.mean(axis=0))**2).sum(axis=0))
+		z = _z(level)
+		lower,upper = full['values']-z*sigmas,full['values']+z*sigmas
+		spread = lambda p: np.sqrt((ngroups-1.0)*p.var(axis=1))
+	else:
+		sigmas = samples.std(axis=0,ddof=1)
+		tail = 100*(1-level)/2
+		lower = np.percentile(samples,tail,axis=0)
+		upper = np.percentile(samples,100-tail,axis=0)
+		spread = lambda p: p.std(axis=1,ddof=1)
+	# pointing uncertainty map: spread of each replicate's predicted offsets
+	ha = np.arange(-180,180+map_step,map_step)
+	dec = np.arange(-80,80+map_step,map_step)
+	H,D = np.meshgrid(ha,dec)
+	G = mount_model.design_matrix(terms,H.ravel(),D.ravel(),lat)
+	predicted = np.dot(G,samples.T)
+	m = H.size
+	sky = np.sqrt(spread(predicted[:m])**2+spread(predicted[m:])**2).reshape(H.shape)
+	return {
+		'terms':terms,
+		'values':full['values'],
+		'formal':full['sigmas'],
+		'samples':samples,
+		'sigmas':sigmas,
+		'lower':lower,
+		'upper':upper,
+		'level':level,
+		'method':method,
+		'map':{'ha':ha,'dec':dec,'sigma':sky}}
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import fits
+
+'''
+Plate solutions cached by a hash of the pixel data, so renamed or re-tagged
+frames are never uploaded twice.
+'''
+
+SUCCESS = 'success'
+FAILURE = 'failure'
+
+def default_path(P):
+	'''
+	The session database lives next to the FITS files unless
+	P['files']['database'] says otherwise.
+	'''
+	files = P.get('files',{})
+	if 'database' in files:
+		return files['database']
+	return os.path.join(files['fit_directory'],'tpoint.db')
+
+class SolutionCache(object):
+	'''
+	SQLite table of solve results keyed by fits.pixel_hash.  Safe to share
+	between threads.
+	'''
+	def __init__(self,path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(path,check_same_thread=False)
+		with self._db:
+			self._db.execute('''CREATE TABLE IF NOT EXISTS solutions (
+				hash TEXT PRIMARY KEY,
+				status TEXT NOT NULL,
+				calibration TEXT,
+				job_id INTEGER,
+				error TEXT,
+				path TEXT,
+				updated REAL)''')
+
+	def hash(self,path):
+		return fits.pixel_hash(path)
+
+	def get(self,key):
+		'''
+		Return the cached entry as a dict, or None if the frame was never solved.
+		'''
+		with self._lock:
+			row = self._db.execute('SELECT status,calibration,job_id,error,path,updated FROM solutions WHERE hash=?',(key,)).fetchone()
+		if row is None:
+			return None
+		return {
+			'hash':key,
+			'status':row[0],
+			'calibration':json.loads(row[1]) if row[1] else None,
+			'job_id':row[2],
+			'error':row[3],
+			'path':row[4],
+			'updated':row[5]}
+
+	def put(self,key,status,calibration=None,job_id=None,error=None,path=None):
+		with self._lock:
+			with self._db:
+				self._db.execute('INSERT OR REPLACE INTO solutions VALUES (?,?,?,?,?,?,?)',
+					(key,status,json.dumps(calibration) if calibration else None,job_id,error,path,time.time()))
+
+	def forget(self,key):
+		with self._lock:
+			with self._db:
+				self._db.execute('DELETE FROM solutions WHERE hash=?',(key,))
+
+	def counts(self):
+		with self._lock:
+			rows = self._db.execute('SELECT status,COUNT(*) FROM solutions GROUP BY status').fetchall()
+		return dict(rows)
+
+	def close(self):
+		with self._lock:
+			self._db.close()
@@ -1,43 +1,211 @@
+import os
 import time
+import threading
+import Queue
+import jobs as job_states
+import fits
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 '''
-Watch for new FITs files, add them to some queue...
+Watch for new FITs files, hand them to a pool of solver workers.
+
+A file is only queued once its size has stopped changing for "settle"
+seconds, so frames still being written by the camera are never picked up.
+The work queue is bounded: when solving falls behind the camera, new
+frames wait in the pending table instead of piling up in memory.
+
+With a jobs.JobQueue attached, every settled frame is recorded in the
+durable job table and workers claim it there before solving.  On restart
+the watcher resumes from the table: interrupted and pending frames are
+re-queued, finished ones are never solved again.
 '''
 
 class Watcher:
-    
-    def __init__(self,P):
+
+    def __init__(self,P,solver=None,jobs=None):
+        '''
+        P: survey configuration, watches P['files']['fit_directory']
+        solver: callable(path) run by each worker, may block.  A return
+                value with a non-empty "error" attribute counts as a failure
+        jobs: optional jobs.JobQueue for durable job state
+        '''
+        settings = P.get('dispatch',{})
         self.observer = Observer()
-        self.DIRECTORY_TO_WATCH = P['FIT_Directory']
+        self.DIRECTORY_TO_WATCH = P['files']['fit_directory']
+        self.settle = settings.get('settle',2.0)
+        # each worker blocks on one solve, so by default run as many as
+        # the solver keeps in flight
+        self.workers = settings.get('workers',P.get('astrometry',{}).get('solver',{}).get('max_in_flight',8))
+        self.queue = Queue.Queue(settings.get('max_queue',32))
+        self.retry = settings.get('retry',60)
+        self.solver = solver or report
+        self.jobs = jobs
+        self.pending = {}
+        self.queued = set()
+        # without a job table: frames already solved this run, so the
+        # header update a solve callback makes doesn't queue them again
+        self.completed = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
 
-    def run(self):
-        event_handler = Handler()
+    def seen(self,path):
+        '''
+        Record activity on a file, restarting its settle timer.
+        '''
+        if not path.lower().endswith(fits.EXTENSIONS):
+            return
+        with self.lock:
+            self.pending[path] = (-1,time.time())
+
+    def backlog(self):
+        '''
+        Number of frames waiting to be solved (settling plus queued).
+        '''
+        with self.lock:
+            return len(self.pending) + self.queue.qsize()
+
+    def _settled(self):
+        '''
+        Return pending files whose size hasn't changed for self.settle seconds.
+        '''
+        now = time.time()
+        ready = []
+        with self.lock:
+            for path,(size,changed) in self.pending.items():
+                try:
+                    current = os.path.getsize(path)
+                except OSError:
+                    # deleted or renamed before it settled
+                    del self.pending[path]
+                    continue
+                if current != size:
+                    self.pending[path] = (current,now)
+                elif current > 0 and now-changed >= self.settle:
+                    ready.append(path)
+        return sorted(ready)
+
+    def _enqueue(self,path):
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued.add(path)
+        # blocks while the workers are behind (backpressure)
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(path,timeout=1)
+                return
+            except Queue.Full:
+                print "Solver behind, %d frames waiting" % self.backlog()
+
+    def _sweep(self):
+        '''
+        Queue everything the job table still lists as pending: leftovers
+        from a previous run and frames waiting for a retry.
+        '''
+        for path in self.jobs.select(job_states.PENDING):
+            self._enqueue(path)
+
+    def _stabilize(self):
+        last_sweep = 0
+        while not self.stopped.is_set():
+            if self.jobs and time.time()-last_sweep >= self.retry:
+                self._sweep()
+                last_sweep = time.time()
+            for path in self._settled():
+                if self.jobs is None:
+                    if path not in self.completed:
+                        self._enqueue(path)
+                elif self.jobs.add(path) or self.jobs.state(path) == job_states.PENDING:
+                    self._enqueue(path)
+                with self.lock:
+                    self.pending.pop(path,None)
+            self.stopped.wait(self.settle/4.0)
+
+    def _work(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                self.queue.task_done()
+                return
+            with self.lock:
+                self.queued.discard(path)
+            try:
+                if self.jobs and not self.jobs.claim(path):
+                    # finished already, or claimed by another worker
+                    continue
+                error = None
+                retry = None
+                try:
+                    error = getattr(self.solver(path),'error',None)
+                except Exception as e:
+                    # the solver itself broke, not the frame: try again
+                    error = e
+                    retry = True
+                    print "Error solving %s: %s" % (path,e)
+                if self.jobs:
+                    self.jobs.finish(path,error,retry)
+                else:
+                    with self.lock:
+                        self.completed.add(path)
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        if self.jobs:
+            self.jobs.recover()
+        event_handler = Handler(self)
         self.observer.schedule(event_handler, self.DIRECTORY_TO_WATCH, recursive=True)
         self.observer.start()
-        try:
-            while True:
-                time.sleep(5)
-        except:
-            self.observer.stop()
-            print "Error"
+        self.threads = [threading.Thread(target=self._stabilize)]
+        for i in range(self.workers):
+            self.threads.append(threading.Thread(target=self._work))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
 
+    def stop(self):
+        self.stopped.set()
+        self.observer.stop()
         self.observer.join()
+        self.threads[0].join()
+        for t in self.threads[1:]:
+            self.queue.put(None)
+        for t in self.threads[1:]:
+            t.join()
+
+    def run(self):
+        self.start()
+        try:
+            while self.observer.is_alive():
+                self.observer.join(1)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
 
 
 class Handler(FileSystemEventHandler):
 
-    @staticmethod
-    def on_any_event(event):
+    def __init__(self,watcher):
+        self.watcher = watcher
+
+    def on_any_event(self,event):
         if event.is_directory:
             return None
 
-        elif event.event_type == 'created':
-            # Take any action here when a file is first created.
-            print "Received created event - %s." % event.src_path
+        elif event.event_type in ('created','modified'):
+            self.watcher.seen(event.src_path)
+
+        elif event.event_type == 'moved':
+            self.watcher.seen(event.dest_path)
+
+
+def report(path):
+    print "Ready to solve - %s." % path
 
 
 if __name__ == '__main__':
-    w = Watcher()
-    w.run()
\ No newline at end of file
+    import json
+    w = Watcher(json.load(open('test_input.json')))
+    w.run()
@@ -0,0 +1,161 @@
+import os
+import time
+import numpy as np
+import fits
+import index
+import jobs
+import parallel
+
+'''
+Compile TPOINT data files (step 4 of the survey) from solved frames.
+
+Each session becomes one TPOINT block: caption, options, site record, one
+line per solved frame (true RA/Dec from the plate solution, the RA/Dec the
+mount reported, sidereal time) and END.  Sessions are rendered on a process
+pool and written out in order as they finish, so memory is bounded by a
+few sessions whatever the size of the archive.  Output reads back with
+mount_model.parse_tpoint.
+'''
+
+OPTIONS = (':NODA',':EQUAT')
+
+def _split(value,scale,units):
+	'''
+	Round to the last printed digit first so carries propagate, then split
+	into sign, whole units, minutes and the rest.
+	'''
+	value = np.asarray(value,dtype=np.float64)
+	sign = np.where(value < 0,'-','+')
+	ticks = np.round(np.abs(value)*scale).astype(np.int64)
+	whole,rest = np.divmod(ticks,60*units)
+	minutes,rest = np.divmod(rest,units)
+	return sign,whole,minutes,rest
+
+def _ra(deg):
+	'''
+	hh mm ss.ss
+	'''
+	sign,h,m,cs = _split(np.mod(deg,360)/15.0,360000,6000)
+	h = h % 24
+	return ['%02d %02d %02d.%02d' % v for v in zip(h,m,cs//100,cs % 100)]
+
+def _dec(deg):
+	'''
+	+dd mm ss.s
+	'''
+	sign,d,m,ds = _split(deg,36000,600)
+	return ['%s%02d %02d %02d.%d' % v for v in zip(sign,d,m,ds//10,ds % 10)]
+
+def _lst(deg):
+	'''
+	hh mm.mm
+	'''
+	sign,h,m,cm = _split(np.mod(deg,360)/15.0,6000,100)
+	return ['%02d %02d.%02d' % v for v in zip(h % 24,m,cm)]
+
+def _site(lat,utc):
+	'''
+	Site record: latitude +dd mm ss, then the date.
+	'''
+	sign,d,m,s = _split([lat],3600,60)
+	date = time.strftime('%Y %m %d',time.gmtime(utc if np.isfinite(utc) else 0))
+	return '%s%02d %02d %02d %s' % (sign[0],d[0],m[0],s[0],date)
+
+def observations(table):
+	'''
+	Observation lines for the solved, non-rejected rows of an index table.
+	'''
+	ok = (np.isfinite(table['solved_ra']) & np.isfinite(table['solved_dec']) &
+		np.isfinite(table['ra']) & np.isfinite(table['dec']) &
+		np.isfinite(table['lst']) & ~table['rejected'].astype(bool))
+	if not ok.any():
+		return []
+	columns = (_ra(table['solved_ra'][ok]),_dec(table['solved_dec'][ok]),
+		_ra(table['ra'][ok]),_dec(table['dec'][ok]),_lst(table['lst'][ok]))
+	return ['  '.join(line) for line in zip(*columns)]
+
+def block(table,caption,options=OPTIONS):
+	'''
+	One session as TPOINT text, or '' if it has no usable frames.
+	'''
+	lines = observations(table)
+	if not lines:
+		return ''
+	head = [caption]+list(options)+[_site(np.nanmedian(table['lat']),np.nanmin(table['utc']))]
+	return '\n'.join(head+lines+['END'])+'\n'
+
+def _from_index(task):
+	directory,session,options = task
+	return block(index.SessionIndex(directory).read(session),session,options)
+
+def _from_fits(task):
+	paths,session,options = task
+	records = []
+	for path in paths:
+		try:
+			header = fits.read_header(path,fits.TPOINT_KEYS)
+		except (IOError,ValueError) as e:
+			print "Skipping unreadable file %s: %s" % (path,e)
+			continue
+		if header.get('TP_KEY') == session:
+			records.append(index.record(path,header))
+	return block(index.to_columns(records),session,options)
+
+def fits_sessions(directory):
+	'''
+	Frames under directory grouped by session, from the file names alone.
+	'''
+	sessions = {}
+	for root,dirs,files in os.walk(directory):
+		for name in sorted(files):
+			if name.lower().endswith(fits.EXTENSIONS):
+				session = jobs.session_of(name)
+				if session is not None:
+					sessions.setdefault(session,[]).append(os.path.join(root,name))
+	return sessions
+
+def _write(out,render,tasks,processes):
+	'''
+	Render tasks on a pool, writing blocks in task order as they arrive.
+	'''
+	if isinstance(out,basestring):
+		with open(out,'w') as f:
+			return _write(f,render,tasks,processes)
+	count = 0
+	workers = None
+	if parallel.processes(processes) > 1 and len(tasks) > 1:
+		workers = parallel.pool(processes,None,())
+		results = workers.imap(render,tasks)
+	else:
+		results = (render(t) for t in tasks)
+	try:
+		for text in results:
+			if text:
+				out.write(text)
+				count += 1
+	finally:
+		if workers is not None:
+			workers.terminate()
+	return count
+
+def export_index(out,directory,sessions=None,options=OPTIONS,processes=None):
+	'''
+	Write a TPOINT file (path or open file) from a session index directory.
+	Returns the number of sessions written.
+	'''
+	if sessions is None:
+		sessions = index.SessionIndex(directory).sessions()
+	elif isinstance(sessions,basestring):
+		sessions = [sessions]
+	return _write(out,_from_index,[(directory,s,options) for s in sessions],processes)
+
+def export_fits(out,directory,sessions=None,options=OPTIONS,processes=None):
+	'''
+	Write a TPOINT file straight from the FITS headers under directory.
+	'''
+	found = fits_sessions(directory)
+	if sessions is None:
+		sessions = sorted(found)
+	elif isinstance(sessions,basestring):
+		sessions = [sessions]
+	return _write(out,_from_fits,[(found.get(s,[]),s,options) for s in sessions],processes)
@@ -0,0 +1,222 @@
+import os
+import mmap
+import hashlib
+
+'''
+Minimal FITS helpers.  Only what tpoint needs, no general FITS library.
+
+Files are memory mapped and only the 2880 byte header blocks up to the END
+card are ever touched, so reading the tpoint keys from a frame costs about
+the same whatever the size of the image.
+'''
+
+EXTENSIONS = ('.fit','.fits','.fts')
+BLOCK = 2880
+CARD = 80
+
+# header keys needed to build a tpoint data set
+TPOINT_KEYS = ('TP_KEY','TP_AZ','TP_EL','TP_RA','TP_DEC','TP_UTC','TP_LAT','TP_LON','TP_LST',
+	'CRVAL1','CRVAL2','CRPIX1','CRPIX2','CD1_1','CD1_2','CD2_1','CD2_2',
+	'TP_SOLVD','TP_SRA','TP_SDEC','TP_SPA','TP_SSCL')
+
+def _map(f):
+	try:
+		return mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+	except ValueError:
+		# empty file
+		raise ValueError('not a FITS file: %s' % f.name)
+
+def header_end(mm):
+	'''
+	Given a mapped FITS file, return the offset just past the END card.
+	'''
+	pos = 0
+	while True:
+		pos = mm.find('END',pos)
+		if pos == -1:
+			raise ValueError('FITS header has no END card')
+		if pos % CARD == 0 and mm[pos:pos+8] == 'END     ':
+			return pos+CARD
+		pos += 1
+
+def data_offset(f):
+	'''
+	Given an open FITS file, return the byte offset where the primary
+	header ends (the start of the pixel data).
+	'''
+	mm = _map(f)
+	try:
+		end = header_end(mm)
+	finally:
+		mm.close()
+	return -(-end//BLOCK)*BLOCK
+
+def pixel_hash(path,chunk=1<<20):
+	'''
+	Return a sha1 hex digest of everything after the primary header.
+	Editing header keys does not change the hash, new pixels do.
+	'''
+	h = hashlib.sha1()
+	with open(path,'rb') as f:
+		mm = _map(f)
+		try:
+			start = -(-header_end(mm)//BLOCK)*BLOCK
+			for i in range(start,len(mm),chunk):
+				h.update(mm[i:i+chunk])
+		finally:
+			mm.close()
+	return h.hexdigest()
+
+def parse_value(text):
+	'''
+	Convert the value field of a header card to a python type.
+	'''
+	text = text.strip()
+	if text.startswith("'"):
+		# strings are quoted, embedded quotes doubled, comment follows
+		end = 1
+		while True:
+			end = text.find("'",end)
+			if end == -1:
+				return text[1:].rstrip()
+			if text[end+1:end+2] == "'":
+				end += 2
+				continue
+			return text[1:end].replace("''","'").rstrip()
+	text = text.split('/',1)[0].strip()
+	if text == 'T':
+		return True
+	if text == 'F':
+		return False
+	try:
+		return int(text)
+	except ValueError:
+		pass
+	try:
+		return float(text.replace('D','E'))
+	except ValueError:
+		return text or None
+
+def read_header(path,keys=None):
+	'''
+	Return the primary header of a FITS file as a dict of typed values.
+	Keys are upper case, as stored in the file.  If keys is given only
+	those cards are parsed.
+	'''
+	with open(path,'rb') as f:
+		mm = _map(f)
+		try:
+			text = mm[:header_end(mm)]
+		finally:
+			mm.close()
+	wanted = None
+	if keys is not None:
+		wanted = set(k.upper() for k in keys)
+	header = {}
+	for i in range(0,len(text),CARD):
+		key = text[i:i+8].rstrip()
+		if wanted is not None and key not in wanted:
+			continue
+		if text[i+8:i+10] == '= ':
+			header[key] = parse_value(text[i+10:i+CARD])
+	return header
+
+def scan(directory,keys=TPOINT_KEYS,session=None):
+	'''
+	Walk a directory tree, yielding (path,header) for each tpoint frame
+	(one with a TP_KEY), optionally only those from one session.
+	'''
+	if keys is not None and 'TP_KEY' not in keys:
+		keys = tuple(keys)+('TP_KEY',)
+	for root,dirs,files in os.walk(directory):
+		for name in sorted(files):
+			if not name.lower().endswith(EXTENSIONS):
+				continue
+			path = os.path.join(root,name)
+			try:
+				header = read_header(path,keys)
+			except (IOError,ValueError) as e:
+				print "Skipping unreadable file %s: %s" % (path,e)
+				continue
+			if 'TP_KEY' not in header:
+				continue
+			if session is not None and header['TP_KEY'] != session:
+				continue
+			yield path,header
+
+# solution keys, reserved at capture and patched in place after solving
+SOLUTION_KEYS = ('TP_SOLVD','TP_SRA','TP_SDEC','TP_SPA','TP_SSCL')
+
+def format_card(key,value):
+	'''
+	Return an 80 character header card for key = value.
+	'''
+	if isinstance(value,bool):
+		text = '%20s' % ('T' if value else 'F')
+	elif isinstance(value,(int,long)):
+		text = '%20d' % value
+	elif isinstance(value,float):
+		text = '%.15G' % value
+		if '.' not in text and 'E' not in text:
+			text += '.'
+		text = '%20s' % text
+	else:
+		text = "'%-8s'" % str(value).replace("'","''")
+	card = '%-8s= %s' % (key.upper(),text)
+	if len(key) > 8 or len(card) > CARD:
+		raise ValueError('value too long for a header card: %s' % key)
+	return card.ljust(CARD)
+
+def update_header(path,values):
+	'''
+	Set header keys in place without touching the pixel data.  Existing
+	cards are overwritten; new ones go in the free space after END in the
+	last header block.  All changes are made with one write of the few
+	cards involved, so the cost does not depend on the image size.
+	Raises ValueError if a new key doesn't fit (reserve it at capture).
+	'''
+	with open(path,'r+b') as f:
+		mm = _map(f)
+		try:
+			end = header_end(mm)
+			cards = dict((mm[i:i+8].rstrip(),i) for i in range(end-CARD-CARD,-1,-CARD))
+		finally:
+			mm.close()
+		changes = {}
+		pos = end-CARD
+		for key,value in sorted(values.items()):
+			card = format_card(key,value)
+			if key.upper() in cards:
+				changes[cards[key.upper()]] = card
+			else:
+				changes[pos] = card
+				pos += CARD
+		if pos != end-CARD:
+			if pos+CARD > -(-end//BLOCK)*BLOCK:
+				raise ValueError('no room for new keys in header of %s' % path)
+			changes[pos] = 'END'.ljust(CARD)
+		if not changes:
+			return
+		lo = min(changes)
+		hi = max(changes)+CARD
+		f.seek(lo)
+		span = bytearray(f.read(hi-lo))
+		for offset,card in changes.items():
+			span[offset-lo:offset-lo+CARD] = card
+		f.seek(lo)
+		f.write(span)
+
+def write_solution(path,calibration):
+	'''
+	Store an astrometry.net calibration (or a failure, if None) in the
+	frame's reserved solution keys.
+	'''
+	if not calibration:
+		update_header(path,{'TP_SOLVD':-1})
+		return
+	update_header(path,{
+		'TP_SOLVD':1,
+		'TP_SRA':float(calibration['ra']),
+		'TP_SDEC':float(calibration['dec']),
+		'TP_SPA':float(calibration.get('orientation',0)),
+		'TP_SSCL':float(calibration.get('pixscale',0))})
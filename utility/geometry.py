@@ -24,6 +24,28 @@ def vrotate(vector,axis,theta_rad):
     rotated = np.dot(M,vector)
     return rotated
 
+def vrotate_many(vectors,axes,theta_rad):
+    '''
+    rotate N vectors (N x 3) about N axes (N x 3, or one axis) by N angles
+    (radians, or one angle) in one go, returns N x 3
+    '''
+    vectors = np.atleast_2d(np.asarray(vectors,dtype=float))
+    axes = np.atleast_2d(np.asarray(axes,dtype=float))
+    axes = axes/np.linalg.norm(axes,axis=1)[:,None]
+    theta = np.asarray(theta_rad,dtype=float)
+    n = max(len(vectors),len(axes),theta.size)
+    axes = np.broadcast_to(axes,(n,3))
+    theta = np.broadcast_to(theta.ravel() if theta.size > 1 else theta.reshape(1),(n,))
+    # same quaternion form as vrotate, one matrix per row
+    a = np.cos(theta/2.0)
+    b,c,d = (-axes*np.sin(theta/2.0)[:,None]).T
+    aa, bb, cc, dd = a*a, b*b, c*c, d*d
+    bc, ad, ac, ab, bd, cd = b*c, a*d, a*c, a*b, b*d, c*d
+    M = np.array([[aa+bb-cc-dd, 2*(bc+ad), 2*(bd-ac)],
+                     [2*(bc-ad), aa+cc-bb-dd, 2*(cd+ab)],
+                     [2*(bd+ac), 2*(cd-ab), aa+dd-bb-cc]])
+    return np.einsum('ijn,nj->ni',M,np.broadcast_to(vectors,(n,3)))
+
 def azel2xyz(az,el):
     x = np.cos(np.deg2rad(el))*np.cos(np.deg2rad(az))
     y = np.cos(np.deg2rad(el))*np.sin(np.deg2rad(az))
@@ -48,6 +70,20 @@ def meridian_rotate(az,el,theta_deg):
     az,el = xyz2azel(rotated)
     return az,el
 
+def meridian_rotate_many(az,el,theta_deg):
+    '''
+    meridian_rotate for arrays of az/el/theta (deg, broadcast together),
+    returns az/el arrays
+    '''
+    az,el,theta = np.broadcast_arrays(np.asarray(az,dtype=float),np.asarray(el,dtype=float),np.asarray(theta_deg,dtype=float))
+    v = np.column_stack(azel2xyz(az.ravel(),el.ravel()))
+    axis = np.column_stack(azel2xyz(az.ravel(),el.ravel()+90))
+    rotated = vrotate_many(v,axis,np.deg2rad(theta.ravel()))
+    rotated = rotated/np.linalg.norm(rotated,axis=1)[:,None]
+    raz = np.rad2deg(np.arctan2(rotated[:,1],rotated[:,0]))
+    rel = 90 - np.rad2deg(np.arccos(np.clip(rotated[:,2],-1,1)))
+    return raz.reshape(az.shape),rel.reshape(az.shape)
+
 def compute_sidereal_time(lon,lat=0,alt=0,t=datetime.utcnow()):
     '''
         Return local apparent sidereal time in decimal hours:
@@ -95,6 +131,68 @@ def RaDec2AzEl(DateTime,Ra,Dec,Lat,Lon,Alt=0,display=False):
     az, alt = np.degrees([body.az, body.alt])
     return az, alt
 
+def _precession(DateTime):
+    '''
+    Rotation matrix taking J2000 unit vectors to the equinox of date, from
+    three pyephem conversions.
+    '''
+    date = ephem.Date(DateTime)
+    M = np.empty((3,3))
+    for i,(ra,dec) in enumerate(((0,0),(math.pi/2,0),(0,math.pi/2))):
+        eq = ephem.Equatorial(ephem.Equatorial(ra,dec,epoch=ephem.J2000),epoch=date)
+        M[:,i] = [math.cos(eq.dec)*math.cos(eq.ra),math.cos(eq.dec)*math.sin(eq.ra),math.sin(eq.dec)]
+    return M
+
+def precess(DateTime,Ra,Dec):
+    '''
+    J2000 ra/dec arrays (deg) to the equinox of DateTime (deg).
+    '''
+    ra = np.deg2rad(np.asarray(Ra,dtype=float))
+    dec = np.deg2rad(np.asarray(Dec,dtype=float))
+    v = np.array([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)*np.ones_like(ra)])
+    x,y,z = np.tensordot(_precession(DateTime),v,axes=1)
+    return np.rad2deg(np.arctan2(y,x)) % 360,np.rad2deg(np.arcsin(np.clip(z,-1,1)))
+
+def precess_to_date(Utc,Ra,Dec,step=86400.0):
+    '''
+    J2000 ra/dec (deg) to the equinox of date at each Utc (POSIX seconds),
+    all broadcast together.  Precession moves a star well under an
+    arcsecond a day, so one rotation is built per step seconds.  NaN where
+    Utc is NaN.
+    '''
+    utc,ra,dec = np.broadcast_arrays(*[np.asarray(v,dtype=float) for v in (Utc,Ra,Dec)])
+    shape = utc.shape
+    utc,ra,dec = utc.ravel(),ra.ravel(),dec.ravel()
+    out_ra = np.full(utc.shape,np.nan)
+    out_dec = np.full(utc.shape,np.nan)
+    rows = np.flatnonzero(np.isfinite(utc))
+    bins = np.floor(utc[rows]/step)
+    for b in np.unique(bins):
+        sel = rows[bins == b]
+        out_ra[sel],out_dec[sel] = precess(datetime.utcfromtimestamp((b+0.5)*step),ra[sel],dec[sel])
+    return out_ra.reshape(shape)[()],out_dec.reshape(shape)[()]
+
+def HaDec2AzEl_many(Ha,Dec,Lat):
+    '''
+    Hour angle/declination arrays (deg, broadcast together) to az/el (deg).
+    '''
+    ha = np.deg2rad(Ha)
+    dec = np.deg2rad(Dec)
+    lat = np.deg2rad(Lat)
+    el = np.arcsin(np.sin(dec)*np.sin(lat)+np.cos(dec)*np.cos(lat)*np.cos(ha))
+    az = np.arctan2(-np.cos(dec)*np.sin(ha),np.sin(dec)*np.cos(lat)-np.cos(dec)*np.sin(lat)*np.cos(ha))
+    return np.rad2deg(az) % 360,np.rad2deg(el)
+
+def RaDec2AzEl_many(DateTime,Ra,Dec,Lat,Lon,Alt=0):
+    '''
+    Vectorized RaDec2AzEl: arrays of J2000 ra/dec (deg) at one time and
+    place to az/el arrays (deg).  Precession and sidereal time come from
+    pyephem once per call; nutation and aberration are ignored, so results
+    agree with RaDec2AzEl to about half an arcminute.
+    '''
+    ra,dec = precess(DateTime,Ra,Dec)
+    return HaDec2AzEl_many(compute_sidereal_time(Lon,Lat,Alt,DateTime)*15-ra,dec,Lat)
+
 def AzEl2RaDec(DateTime,Az,El,Lat,Lon,Alt=0,display=False):
     '''
     Given az/el pointing and an observation lat(deg),lon(deg),alt(m) at a UTC time
@@ -0,0 +1,215 @@
+import os
+import calendar
+import threading
+from datetime import datetime
+import numpy as np
+import fits
+import geometry
+
+'''
+Columnar index of survey observations, one .npz file per session.
+
+Each row is one frame: where the mount was told to point, what it reported,
+when and where it was taken, and (once solved) where it actually pointed.
+All angles are degrees, residuals are arcseconds on the sky, utc is POSIX
+seconds.  Loading every session is a handful of np.load calls, so model
+fitting and plotting never have to go back to the FITS files.
+'''
+
+COLUMNS = (
+	('path',str),
+	('session',str),
+	('frame',np.int32),
+	('utc',np.float64),
+	('lat',np.float64),
+	('lon',np.float64),
+	('lst',np.float64),
+	('cmd_az',np.float64),
+	('cmd_el',np.float64),
+	('ra',np.float64),
+	('dec',np.float64),
+	('solved_ra',np.float64),
+	('solved_dec',np.float64),
+	('d_ra',np.float64),
+	('d_dec',np.float64),
+	('rejected',np.bool_),
+	)
+
+def default_path(P):
+	'''
+	The index lives in an "index" folder next to the FITS files unless
+	P['files']['index'] says otherwise.
+	'''
+	files = P['files']
+	return files.get('index',os.path.join(files['fit_directory'],'index'))
+
+def _float(header,key,scale=1.0):
+	try:
+		return float(header[key])*scale
+	except (KeyError,TypeError,ValueError):
+		return np.nan
+
+def record(path,header,solution=None):
+	'''
+	Build one index row from a frame's header.  The solved position comes
+	from solution (an astrometry.net calibration) if given, otherwise from
+	the tp_s* solution keys or the solved WCS in the header.
+	'''
+	name = os.path.splitext(os.path.basename(path))[0]
+	try:
+		frame = int(name.rsplit('_',1)[1])
+	except (IndexError,ValueError):
+		frame = -1
+	try:
+		t = datetime.strptime(header['TP_UTC'],"%Y-%m-%dT%H:%M:%S.%f")
+		utc = calendar.timegm(t.timetuple())+t.microsecond/1e6
+	except (KeyError,TypeError,ValueError):
+		utc = np.nan
+	row = {
+		'path':path,
+		'session':str(header.get('TP_KEY','')),
+		'frame':frame,
+		'utc':utc,
+		'lat':_float(header,'TP_LAT'),
+		'lon':_float(header,'TP_LON'),
+		'lst':_float(header,'TP_LST',15.0),
+		'cmd_az':_float(header,'TP_AZ'),
+		'cmd_el':_float(header,'TP_EL'),
+		'ra':_float(header,'TP_RA',15.0),
+		'dec':_float(header,'TP_DEC'),
+		'solved_ra':np.nan,
+		'solved_dec':np.nan,
+		'rejected':False}
+	if solution:
+		row['solved_ra'] = float(solution['ra'])
+		row['solved_dec'] = float(solution['dec'])
+	elif header.get('TP_SOLVD') == 1:
+		row['solved_ra'] = _float(header,'TP_SRA')
+		row['solved_dec'] = _float(header,'TP_SDEC')
+	elif 'CRVAL1' in header and 'CRVAL2' in header:
+		row['solved_ra'] = _float(header,'CRVAL1')
+		row['solved_dec'] = _float(header,'CRVAL2')
+	residuals(row)
+	return row
+
+def residuals(table):
+	'''
+	Fill d_ra/d_dec (arcsec, solved minus reported) in a row or table.
+	The mount reports coordinates of date, so the J2000 solution is
+	precessed to the frame's date first.
+	'''
+	solved_ra,solved_dec = geometry.precess_to_date(table['utc'],table['solved_ra'],table['solved_dec'])
+	d_ra = (solved_ra-table['ra']+180) % 360 - 180
+	table['d_ra'] = d_ra*np.cos(np.deg2rad(table['dec']))*3600
+	table['d_dec'] = (solved_dec-table['dec'])*3600
+
+def empty():
+	return dict((name,np.zeros(0,dtype=kind)) for name,kind in COLUMNS)
+
+def to_columns(records):
+	'''
+	Turn a list of row dicts into a table (dict of arrays).
+	'''
+	if not records:
+		return empty()
+	return dict((name,np.array([r[name] for r in records],dtype=kind)) for name,kind in COLUMNS)
+
+def concatenate(tables):
+	tables = [t for t in tables if len(t['path'])]
+	if not tables:
+		return empty()
+	return dict((name,np.concatenate([t[name] for t in tables])) for name,kind in COLUMNS)
+
+def take(table,rows):
+	return dict((name,table[name][rows]) for name in table)
+
+class SessionIndex(object):
+	'''
+	Directory of per-session .npz tables, updated a few frames at a time.
+	'''
+	def __init__(self,directory):
+		self.directory = directory
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._lock = threading.Lock()
+
+	def path(self,session):
+		return os.path.join(self.directory,session+'.npz')
+
+	def sessions(self):
+		return sorted(os.path.splitext(f)[0] for f in os.listdir(self.directory) if f.endswith('.npz'))
+
+	def read(self,session):
+		path = self.path(session)
+		if not os.path.exists(path):
+			return empty()
+		with np.load(path) as data:
+			table = empty()
+			table.update(dict((name,data[name]) for name in data.files))
+			return table
+
+	def write(self,session,table):
+		tmp = os.path.join(self.directory,'.'+session+'.tmp.npz')
+		np.savez(tmp,**table)
+		if os.name == 'nt' and os.path.exists(self.path(session)):
+			os.remove(self.path(session))
+		os.rename(tmp,self.path(session))
+
+	def update(self,records):
+		'''
+		Add or replace rows (matched on path), rewriting only the sessions
+		they belong to.
+		'''
+		by_session = {}
+		for r in records:
+			by_session.setdefault(r['session'],[]).append(r)
+		with self._lock:
+			for session,rows in by_session.items():
+				new = to_columns(rows)
+				table = self.read(session)
+				keep = ~np.in1d(table['path'],new['path'])
+				table = concatenate([take(table,keep),new])
+				table = take(table,np.argsort(table['frame'],kind='mergesort'))
+				self.write(session,table)
+
+	def load(self,sessions=None):
+		'''
+		Return one table holding every row of the given sessions (default all).
+		'''
+		if sessions is None:
+			sessions = self.sessions()
+		elif isinstance(sessions,basestring):
+			sessions = [sessions]
+		return concatenate([self.read(s) for s in sessions])
+
+	def flag(self,paths,rejected):
+		'''
+		Set the rejected column for the given frames.
+		'''
+		paths = np.asarray(paths)
+		rejected = np.asarray(rejected,dtype=bool)
+		order = np.argsort(paths)
+		paths,rejected = paths[order],rejected[order]
+		with self._lock:
+			for session in self.sessions():
+				table = self.read(session)
+				found = np.in1d(table['path'],paths)
+				if not found.any():
+					continue
+				table['rejected'][found] = rejected[np.searchsorted(paths,table['path'][found])]
+				self.write(session,table)
+
+	def solved(self,job):
+		'''
+		SolveManager callback: index a frame as soon as it is solved.
+		'''
+		header = fits.read_header(job.path,fits.TPOINT_KEYS)
+		self.update([record(job.path,header,job.calibration)])
+
+	def build(self,directory,session=None):
+		'''
+		(Re)index every frame found under directory from its FITS header.
+		'''
+		records = [record(p,h) for p,h in fits.scan(directory,session=session)]
+		self.update(records)
+		return len(records)
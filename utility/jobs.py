@@ -0,0 +1,163 @@
+import os
+import time
+import sqlite3
+import threading
+
+'''
+Durable table of frames awaiting plate solve.
+
+Every frame gets one row, keyed by path, which moves through:
+
+	pending -> running -> done
+	                   -> pending (transient error, until max_attempts)
+	                   -> failed
+
+The table lives in SQLite (WAL mode) so the survey, the watcher and any
+number of worker threads or processes can share it, and a crash loses
+nothing: recover() puts interrupted jobs back to pending on restart.
+'''
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING,RUNNING,DONE,FAILED)
+
+# SolveManager errors worth another attempt; anything else (e.g. 'no
+# solution') is a property of the frame and won't change on a retry
+TRANSIENT = ('upload failed','timed out')
+
+def transient(error):
+	return str(error).startswith(TRANSIENT)
+
+def session_of(path):
+	'''
+	Survey frames are named <session_key>_<n>.fits
+	'''
+	name = os.path.basename(path)
+	if '_' in name:
+		return name.rsplit('_',1)[0]
+	return None
+
+class JobQueue(object):
+	'''
+	SQLite job table.  Each thread gets its own connection, claims are
+	made inside an immediate transaction so two workers never get the
+	same frame.
+	'''
+	def __init__(self,path,max_attempts=3):
+		self.path = path
+		self.max_attempts = max_attempts
+		self._local = threading.local()
+		db = self._db()
+		db.execute('PRAGMA journal_mode=WAL')
+		db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+			path TEXT PRIMARY KEY,
+			session TEXT,
+			state TEXT NOT NULL,
+			attempts INTEGER NOT NULL DEFAULT 0,
+			created REAL,
+			updated REAL,
+			worker TEXT,
+			error TEXT)''')
+		db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state,created)')
+
+	def _db(self):
+		db = getattr(self._local,'db',None)
+		if db is None:
+			db = sqlite3.connect(self.path,timeout=30,isolation_level=None)
+			self._local.db = db
+		return db
+
+	def add(self,path,session=None):
+		'''
+		Record a new frame as pending.  Returns False if it was already known.
+		'''
+		if session is None:
+			session = session_of(path)
+		now = time.time()
+		cur = self._db().execute('INSERT OR IGNORE INTO jobs (path,session,state,created,updated) VALUES (?,?,?,?,?)',
+			(path,session,PENDING,now,now))
+		return cur.rowcount == 1
+
+	def claim(self,path=None,worker=None):
+		'''
+		Atomically mark a pending job as running.  With a path, claim that
+		frame; otherwise claim the oldest pending frame.  Returns the path
+		claimed, or None.
+		'''
+		if worker is None:
+			worker = '%d:%s' % (os.getpid(),threading.current_thread().name)
+		db = self._db()
+		db.execute('BEGIN IMMEDIATE')
+		try:
+			if path is None:
+				row = db.execute('SELECT path FROM jobs WHERE state=? ORDER BY created LIMIT 1',(PENDING,)).fetchone()
+				if row is None:
+					return None
+				path = row[0]
+			cur = db.execute('UPDATE jobs SET state=?,attempts=attempts+1,worker=?,updated=? WHERE path=? AND state=?',
+				(RUNNING,worker,time.time(),path,PENDING))
+			if cur.rowcount != 1:
+				return None
+			return path
+		finally:
+			db.execute('COMMIT')
+
+	def finish(self,path,error=None,retry=None):
+		'''
+		Mark a running job done, or record the error.  Retryable errors
+		(by default those transient() accepts) send the job back to pending
+		until max_attempts is reached, any other error fails it at once.
+		'''
+		db = self._db()
+		if error is None:
+			db.execute('UPDATE jobs SET state=?,error=NULL,updated=? WHERE path=?',(DONE,time.time(),path))
+			return DONE
+		db.execute('BEGIN IMMEDIATE')
+		try:
+			if retry is None:
+				retry = transient(error)
+			row = db.execute('SELECT attempts FROM jobs WHERE path=?',(path,)).fetchone()
+			state = PENDING if retry and row is not None and row[0] < self.max_attempts else FAILED
+			db.execute('UPDATE jobs SET state=?,error=?,updated=? WHERE path=?',(state,str(error),time.time(),path))
+		finally:
+			db.execute('COMMIT')
+		return state
+
+	def recover(self):
+		'''
+		Return jobs left running by a crashed process to pending.  Only call
+		this when no other worker is alive.
+		'''
+		cur = self._db().execute('UPDATE jobs SET state=?,updated=? WHERE state=?',(PENDING,time.time(),RUNNING))
+		return cur.rowcount
+
+	def state(self,path):
+		row = self._db().execute('SELECT state FROM jobs WHERE path=?',(path,)).fetchone()
+		return row[0] if row else None
+
+	def select(self,state=PENDING,session=None):
+		'''
+		Return paths in the given state, oldest first.
+		'''
+		sql = 'SELECT path FROM jobs WHERE state=?'
+		args = [state]
+		if session is not None:
+			sql += ' AND session=?'
+			args.append(session)
+		rows = self._db().execute(sql+' ORDER BY created',args).fetchall()
+		return [r[0] for r in rows]
+
+	def counts(self,session=None):
+		'''
+		Number of jobs in each state.
+		'''
+		sql = 'SELECT state,COUNT(*) FROM jobs'
+		args = []
+		if session is not None:
+			sql += ' WHERE session=?'
+			args.append(session)
+		counts = dict((s,0) for s in STATES)
+		counts.update(dict(self._db().execute(sql+' GROUP BY state',args).fetchall()))
+		return counts
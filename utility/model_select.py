@@ -0,0 +1,142 @@
+import time
+import numpy as np
+import mount_model
+import parallel
+
+'''
+Automatic choice of mount model terms.
+
+Terms are added one at a time (forward selection).  Each round every
+remaining candidate is scored in parallel on a process pool by k-fold
+cross validation, AIC and BIC.  The design matrix for every candidate term
+is built once and shared with the workers, which reduce it to per-fold
+normal equations, so scoring a term set is a few small solves.
+'''
+
+CANDIDATE_TERMS = ('CH','NP','MA','ME','TF','FO','DAF',
+	'HHSH','HHCH','HDSH','HDCH','HHSH2','HHCH2','HDSH2','HDCH2','HDSD','HDCD')
+
+# per process state, set by _init
+_shared = {}
+
+def _init(A,y,folds):
+	_shared['A'] = parallel.attach(A)
+	_shared['y'] = parallel.attach(y)
+	_shared['folds'] = parallel.attach(folds).astype(int)
+	_shared['stats'] = None
+
+def _stats():
+	'''
+	Normal equations for the whole data set and for each fold, computed
+	once per worker.
+	'''
+	if _shared['stats'] is None:
+		A,y,folds = _shared['A'],_shared['y'],_shared['folds']
+		rows = np.concatenate((folds,folds))
+		stats = [(np.dot(A.T,A),np.dot(A.T,y),np.dot(y,y),len(y)//2)]
+		for k in range(folds.max()+1):
+			Ak = A[rows == k]
+			yk = y[rows == k]
+			stats.append((np.dot(Ak.T,Ak),np.dot(Ak.T,yk),np.dot(yk,yk),len(yk)//2))
+		_shared['stats'] = stats
+	return _shared['stats']
+
+def _solve(G,b):
+	return np.linalg.lstsq(G,b,rcond=1e-12)[0]
+
+def _sse(x,G,b,yy):
+	return yy-2*np.dot(x,b)+np.dot(x,np.dot(G,x))
+
+def _score(columns):
+	'''
+	Score one set of design matrix columns: cross validated sky RMS, AIC
+	and BIC.
+	'''
+	cols = np.asarray(columns)
+	stats = _stats()
+	G,b,yy,n = stats[0]
+	G = G[np.ix_(cols,cols)]
+	b = b[cols]
+	sse = 0.0
+	for Gk,bk,yyk,nk in stats[1:]:
+		Gk = Gk[np.ix_(cols,cols)]
+		bk = bk[cols]
+		x = _solve(G-Gk,b-bk)
+		sse += _sse(x,Gk,bk,yyk)
+	rss = max(_sse(_solve(G,b),G,b,yy),1e-300)
+	m = 2*n
+	k = len(cols)
+	return {
+		'columns':tuple(columns),
+		'cv':np.sqrt(max(sse,0)/n),
+		'aic':m*np.log(rss/m)+2*k,
+		'bic':m*np.log(rss/m)+k*np.log(m)}
+
+def select_terms(data,base=('IH','ID'),candidates=CANDIDATE_TERMS,criterion='cv',
+	folds=5,budget=60.0,processes=None,min_gain=0.01,seed=0):
+	'''
+	Pick the mount model terms that best explain parse_tpoint/from_index
+	style data.
+
+	    base: terms always included
+	candidates: terms to choose from
+	criterion: 'cv' (cross validated sky RMS), 'aic' or 'bic'
+	    folds: number of cross validation folds
+	   budget: seconds; the best model found so far is returned when spent
+	min_gain: with 'cv', stop once a term improves the RMS by less than
+	          this fraction
+	processes: pool size (default one per core, 1 runs in this process)
+
+	Returns a dict with the chosen terms, their scores, the selection
+	history and the fitted model.
+	'''
+	start = time.time()
+	terms = list(base)+[t for t in candidates if t not in base]
+	A = mount_model.design_matrix(terms,data['ha_obs'],data['dec_obs'],data['lat'])
+	y = mount_model.offsets(data)
+	n = len(y)//2
+	fold = np.random.RandomState(seed).permutation(n) % folds
+	handles = (parallel.share(A),parallel.share(y),parallel.share(fold))
+	workers = None
+	if parallel.processes(processes) > 1:
+		workers = parallel.pool(processes,_init,handles)
+		score = workers.imap_unordered
+	else:
+		_init(*handles)
+		score = lambda f,tasks: (f(t) for t in tasks)
+	selected = range(len(base))
+	remaining = range(len(base),len(terms))
+	evaluated = 1
+	try:
+		best = list(score(_score,[selected]))[0]
+		history = [best]
+		while remaining and time.time()-start < budget:
+			results = []
+			for result in score(_score,[selected+[c] for c in remaining]):
+				results.append(result)
+				if time.time()-start >= budget:
+					break
+			evaluated += len(results)
+			if not results:
+				break
+			top = min(results,key=lambda r: r[criterion])
+			gain = best[criterion]-top[criterion]
+			if gain <= 0 or (criterion == 'cv' and gain < min_gain*best[criterion]):
+				break
+			best = top
+			history.append(best)
+			selected = list(best['columns'])
+			remaining = [c for c in remaining if c not in selected]
+	finally:
+		if workers is not None:
+			workers.terminate()
+	chosen = [terms[c] for c in best['columns']]
+	return {
+		'terms':chosen,
+		'cv':best['cv'],
+		'aic':best['aic'],
+		'bic':best['bic'],
+		'history':[([terms[c] for c in h['columns']],h[criterion]) for h in history],
+		'evaluated':evaluated,
+		'seconds':time.time()-start,
+		'model':mount_model.solve_tpoint(data,chosen)}
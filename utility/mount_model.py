@@ -1,16 +1,523 @@
-import numpy as numpy
+import threading
+from collections import deque
+import numpy as np
+import geometry
 
-def parse_tpoint(file):
+'''
+Mount model from TPOINT data.
+
+TheSkyX/TPOINT data files hold one or more sessions, each laid out as:
+
+	caption line
+	:NODA, :EQUAT, :GERMAN ... option records
+	+40 00 00 2018 02 04 ...  site record (latitude first)
+	12 01 02.3 +40 00 00  12 01 05.1 +40 01 12  06 12.5 [pier]
+	...
+	END
+
+Each observation gives the true RA/Dec of the star, the RA/Dec the mount
+reported, and the sidereal time (h m.m).  An optional last column gives the
+pier side (0 east, 1 west); otherwise German mounts flag the flipped side by
+reporting a Dec beyond the pole.  All angles returned are degrees, sidereal
+time is decimal hours.
+'''
+
+# columns in an observation record, without and with the pier side
+RECORD = 14
+RECORD_PIER = 15
+
+def _sexagesimal(d,m,s=0.0):
+	'''
+	Combine d/m/s columns, the sign is carried by the first one (even "-00").
+	'''
+	sign = np.where(np.signbit(d),-1.0,1.0)
+	return sign*(np.abs(d)+m/60.0+s/3600.0)
+
+class _Growable(object):
+	'''
+	Preallocated column store, doubled when full and trimmed at the end.
+	'''
+	def __init__(self,names,size=4096):
+		self.n = 0
+		self.columns = dict((name,np.empty(size,dtype=kind)) for name,kind in names)
+
+	def extend(self,values):
+		count = len(values.values()[0])
+		size = len(self.columns.values()[0])
+		if self.n+count > size:
+			size = max(2*size,self.n+count)
+			for name,column in self.columns.items():
+				grown = np.empty(size,dtype=column.dtype)
+				grown[:self.n] = column[:self.n]
+				self.columns[name] = grown
+		for name,value in values.items():
+			self.columns[name][self.n:self.n+count] = value
+		self.n += count
+
+	def result(self):
+		return dict((name,column[:self.n].copy()) for name,column in self.columns.items())
+
+def _records(lines,ncols):
+	'''
+	Parse a block of observation lines in one numpy call.
+	'''
+	values = np.fromstring(' '.join(lines),sep=' ')
+	if len(values) != ncols*len(lines):
+		# odd line in the block, fall back to one line at a time
+		rows = [np.fromstring(line,sep=' ') for line in lines]
+		rows = [r[:ncols] for r in rows if len(r) >= ncols]
+		values = np.concatenate(rows) if rows else np.zeros(0)
+	return values.reshape(-1,ncols)
+
+def _observations(v,lat,session):
+	ra_obs = _sexagesimal(v[:,0],v[:,1],v[:,2])*15
+	dec_obs = _sexagesimal(v[:,3],v[:,4],v[:,5])
+	ra_cmd = _sexagesimal(v[:,6],v[:,7],v[:,8])*15
+	dec_cmd = _sexagesimal(v[:,9],v[:,10],v[:,11])
+	lst = _sexagesimal(v[:,12],v[:,13])
+	flipped = np.abs(dec_cmd) > 90
+	dec_cmd = np.where(flipped,np.sign(dec_cmd)*180-dec_cmd,dec_cmd)
+	ra_cmd = np.where(flipped,ra_cmd+180,ra_cmd)
+	if v.shape[1] > RECORD:
+		pier = v[:,RECORD].astype(np.int8)
+	else:
+		pier = flipped.astype(np.int8)
+	return {
+		'ha_obs':(lst*15-ra_obs+180) % 360 - 180,
+		'dec_obs':dec_obs,
+		'ha_cmd':(lst*15-ra_cmd+180) % 360 - 180,
+		'dec_cmd':dec_cmd,
+		'lst':lst,
+		'pier':pier,
+		'lat':np.full(len(v),lat),
+		'session':np.full(len(v),session,dtype=np.int32)}
+
+def parse_tpoint(file,chunk=8192):
 	'''
 	Parses TheSkyX Tpoint file...
+
+	Streams the file line by line, parsing observations a block of "chunk"
+	lines at a time straight into numpy arrays, so memory is bounded by the
+	output arrays.  file is a path or an open file.
+
+	Returns a dict of arrays, one entry per observation:
+		ha_obs,dec_obs: true (star) hour angle and declination (deg)
+		ha_cmd,dec_cmd: hour angle and declination reported by the mount (deg)
+		           lst: local sidereal time (hours)
+		          pier: 0 east, 1 west (flipped)
+		           lat: site latitude (deg)
+		       session: index into 'sessions'
+	and 'sessions', a list of {'caption','options','lat'} dicts.
 	'''
-	pass
+	if isinstance(file,basestring):
+		with open(file) as f:
+			return parse_tpoint(f,chunk)
+	out = _Growable([('ha_obs',np.float64),('dec_obs',np.float64),
+		('ha_cmd',np.float64),('dec_cmd',np.float64),('lst',np.float64),
+		('pier',np.int8),('lat',np.float64),('session',np.int32)])
+	sessions = []
+	state = 'caption'
+	block = []
+	ncols = RECORD
+	for line in file:
+		line = line.strip()
+		if not line or line.startswith('!'):
+			continue
+		if state == 'caption':
+			sessions.append({'caption':line,'options':[],'lat':None})
+			state = 'site'
+		elif state == 'site':
+			if line.startswith(':'):
+				sessions[-1]['options'].append(line[1:].upper())
+			else:
+				site = np.fromstring(line,sep=' ')
+				sessions[-1]['lat'] = float(_sexagesimal(site[0],site[1],site[2]))
+				state = 'data'
+		elif line.upper() == 'END':
+			if block:
+				out.extend(_observations(_records(block,ncols),sessions[-1]['lat'],len(sessions)-1))
+				block = []
+			state = 'caption'
+		else:
+			if not block:
+				# the first line of each block decides the record layout
+				ncols = RECORD_PIER if len(line.split()) >= RECORD_PIER else RECORD
+			block.append(line)
+			if len(block) >= chunk:
+				out.extend(_observations(_records(block,ncols),sessions[-1]['lat'],len(sessions)-1))
+				block = []
+	if block:
+		# file ended without END
+		out.extend(_observations(_records(block,ncols),sessions[-1]['lat'],len(sessions)-1))
+	data = out.result()
+	data['sessions'] = sessions
+	return data
+
+# term -> (effect on hour angle, effect on declination), as functions of
+# hour angle h, declination d and latitude p, all radians.  Signs follow the
+# TPOINT manual: the mount reads the true position plus these corrections.
+TERMS = {
+	'IH':(lambda h,d,p: -np.ones_like(h),None),
+	'ID':(None,lambda h,d,p: -np.ones_like(h)),
+	'CH':(lambda h,d,p: -1/np.cos(d),None),
+	'NP':(lambda h,d,p: -np.tan(d),None),
+	'MA':(lambda h,d,p: -np.cos(h)*np.tan(d),lambda h,d,p: np.sin(h)),
+	'ME':(lambda h,d,p: np.sin(h)*np.tan(d),lambda h,d,p: np.cos(h)),
+	'TF':(lambda h,d,p: np.cos(p)*np.sin(h)/np.cos(d),lambda h,d,p: np.cos(p)*np.cos(h)*np.sin(d)-np.sin(p)*np.cos(d)),
+	'FO':(None,lambda h,d,p: np.cos(h)),
+	'DAF':(lambda h,d,p: -(np.cos(p)*np.cos(h)+np.sin(p)*np.tan(d)),None),
+	}
+DEFAULT_TERMS = ('IH','ID','CH','NP','MA','ME','TF','FO','DAF')
 
-def solve_tpoint(file):
+def _harmonic(name):
+	'''
+	TPOINT harmonic terms are named H<result><func><arg>[n], e.g. HDSH2 is a
+	change in Dec proportional to sin(2h).
+	'''
+	if len(name) < 4 or name[0] != 'H' or name[1] not in 'HD' or name[2] not in 'SC' or name[3] not in 'HD':
+		raise KeyError('unknown mount model term: %s' % name)
+	n = int(name[4:] or 1)
+	func = np.sin if name[2] == 'S' else np.cos
+	if name[3] == 'H':
+		f = lambda h,d,p: func(n*h)
+	else:
+		f = lambda h,d,p: func(n*d)
+	if name[1] == 'H':
+		return f,None
+	return None,f
+
+def term(name):
+	name = name.upper()
+	if name in TERMS:
+		return TERMS[name]
+	return _harmonic(name)
+
+def design_matrix(terms,ha,dec,lat):
+	'''
+	Build the (2N x terms) design matrix for N observations in one go.
+	Rows 0..N-1 are the hour angle equations scaled by cos(dec) so both
+	halves are arcsec on the sky, rows N..2N-1 are the Dec equations.
+	ha/dec/lat in degrees.
+	'''
+	h = np.deg2rad(np.asarray(ha,dtype=float))
+	d = np.deg2rad(np.asarray(dec,dtype=float))
+	p = np.deg2rad(np.asarray(lat,dtype=float))*np.ones_like(h)
+	n = len(h)
+	A = np.zeros((2*n,len(terms)))
+	cosd = np.cos(d)
+	for j,name in enumerate(terms):
+		fh,fd = term(name)
+		if fh is not None:
+			A[:n,j] = fh(h,d,p)*cosd
+		if fd is not None:
+			A[n:,j] = fd(h,d,p)
+	return A
+
+def offsets(data):
+	'''
+	Stack the mount-minus-true offsets of parsed data (arcsec on the sky) to
+	match the rows of design_matrix.
+	'''
+	dh = (np.asarray(data['ha_cmd'])-data['ha_obs']+180) % 360 - 180
+	dh = dh*np.cos(np.deg2rad(data['dec_obs']))*3600
+	dd = (np.asarray(data['dec_cmd'])-data['dec_obs'])*3600
+	return np.concatenate((dh,dd))
+
+def from_index(table):
+	'''
+	Turn solved rows of an index.SessionIndex table into parse_tpoint style
+	data: the plate solution is the true position, tp_ra/tp_dec what the
+	mount reported.  The mount works in coordinates of date and the plate
+	solution is J2000, so the solution is precessed to the frame's date.
+	'''
+	solved_ra,solved_dec = geometry.precess_to_date(table['utc'],table['solved_ra'],table['solved_dec'])
+	# frames missing any of the header keys would poison the fit with NaN
+	ok = (np.isfinite(solved_ra) & np.isfinite(solved_dec) & np.isfinite(table['lst']) &
+		np.isfinite(table['ra']) & np.isfinite(table['dec']) & np.isfinite(table['lat']))
+	wrap = lambda a: (a+180) % 360 - 180
+	return {
+		'ha_obs':wrap(table['lst'][ok]-solved_ra[ok]),
+		'dec_obs':solved_dec[ok],
+		'ha_cmd':wrap(table['lst'][ok]-table['ra'][ok]),
+		'dec_cmd':table['dec'][ok],
+		'lst':table['lst'][ok]/15.0,
+		'pier':np.zeros(ok.sum(),dtype=np.int8),
+		'lat':table['lat'][ok],
+		'path':table['path'][ok]}
+
+def lstsq(A,y,w=None):
+	'''
+	Weighted least squares through the SVD.  Returns coefficients, their
+	formal sigmas and the weighted residual sum of squares.
+	'''
+	if w is not None:
+		sw = np.sqrt(w)
+		A = A*sw[:,None]
+		y = y*sw
+	U,s,Vt = np.linalg.svd(A,full_matrices=False)
+	# drop directions the data can't constrain
+	keep = s > s[0]*len(y)*np.finfo(float).eps
+	x = np.dot(Vt[keep].T,np.dot(U[:,keep].T,y)/s[keep])
+	r = y-np.dot(A,x)
+	rss = np.dot(r,r)
+	dof = max(np.count_nonzero(w) if w is not None else len(y),1+len(x))-len(x)
+	cov = np.dot(Vt[keep].T/s[keep]**2,Vt[keep])*rss/dof
+	return x,np.sqrt(np.diag(cov)),rss
+
+def evaluate(model,ha,dec,lat):
+	'''
+	Return the model offsets (arcsec on the sky in hour angle, arcsec in
+	Dec) at the given positions (deg).
+	'''
+	y = np.dot(design_matrix(model['terms'],ha,dec,lat),model['values'])
+	n = len(y)//2
+	return y[:n],y[n:]
+
+# robust weight functions of the normalized residual u, with default tuning
+ROBUST = {
+	'clip':(lambda u,c: (u <= c).astype(float),3.0),
+	'huber':(lambda u,c: np.minimum(1.0,c/np.maximum(u,1e-12)),1.345),
+	'tukey':(lambda u,c: np.where(u < c,(1-(u/c)**2)**2,0.0),4.685),
+	}
+
+def robust_weights(dh,dd,method,c=None):
+	'''
+	Weights for each observation from its sky residual, normalized by a
+	robust (MAD) estimate of the residual scale.
+	'''
+	f,default = ROBUST[method]
+	if c is None:
+		c = default
+	scale = 1.4826*np.median(np.abs(np.concatenate((dh,dd))))
+	u = np.hypot(dh,dd)/(np.sqrt(2)*max(scale,1e-12))
+	return f(u,c),u
+
+def solve_tpoint(file,terms=DEFAULT_TERMS,weights=None,robust=None,clip=3.0,iterations=20):
 	'''
 	Solves for a mount model basedon TheSkyX tpoint data
+
+	file is a tpoint file, or data already returned by parse_tpoint or
+	from_index.  weights, if given, has one entry per observation.
+
+	robust is None for plain least squares, or 'clip' (iterative sigma
+	clipping at clip sigma), 'huber' or 'tukey' (iteratively reweighted
+	least squares).  Reweighting stops when the weights settle, or after
+	iterations.  Observations beyond clip sigma (zero weight for 'clip'
+	and 'tukey') are flagged as rejected.
+
+	Returns a model dict:
+		  terms: term names
+		 values: term values (arcsec)
+		 sigmas: formal 1 sigma uncertainties (arcsec)
+		    rms: sky RMS of the fit residuals, rejected points excluded (arcsec)
+		      n: number of observations
+		  dh,dd: fit residuals, sky arcsec in hour angle and Dec
+		weights: final weight of each observation
+	   rejected: outlier flag for each observation
+	'''
+	data = file if isinstance(file,dict) else parse_tpoint(file)
+	terms = list(terms)
+	A = design_matrix(terms,data['ha_obs'],data['dec_obs'],data['lat'])
+	y = offsets(data)
+	n = len(y)//2
+	base = np.ones(n) if weights is None else np.asarray(weights,dtype=float)
+	w = base
+	iteration = 0
+	while True:
+		values,sigmas,rss = lstsq(A,y,np.concatenate((w,w)))
+		r = y-np.dot(A,values)
+		if robust is None:
+			break
+		# scaled residuals of this fit, used for rejection even if we stop here
+		if robust == 'clip':
+			rw,u = robust_weights(r[:n],r[n:],robust,clip)
+		else:
+			rw,u = robust_weights(r[:n],r[n:],robust)
+		if iteration >= iterations:
+			break
+		iteration += 1
+		new = base*rw
+		if np.abs(new-w).max() < 1e-3:
+			break
+		w = new
+	if robust is None:
+		rejected = w == 0
+	else:
+		rejected = (w == 0) | (u > clip)
+	kept = ~rejected
+	dh,dd = r[:n],r[n:]
+	return {
+		'terms':terms,
+		'values':values,
+		'sigmas':sigmas,
+		'rms':np.sqrt((np.dot(dh[kept],dh[kept])+np.dot(dd[kept],dd[kept]))/max(kept.sum(),1)),
+		'n':n,
+		'dh':dh,
+		'dd':dd,
+		'weights':w,
+		'rejected':rejected,
+		'iterations':iteration}
+
+def fit_index(session_index,sessions=None,terms=DEFAULT_TERMS,robust='tukey'):
+	'''
+	Fit a model to solved frames of an index.SessionIndex and store each
+	frame's rejection flag back in the index.
+	'''
+	data = from_index(session_index.load(sessions))
+	model = solve_tpoint(data,terms,robust=robust)
+	session_index.flag(data['path'],model['rejected'])
+	return model
+
+class RecursiveModel(object):
+	'''
+	Mount model updated one observation at a time (recursive least
+	squares), so the fit can be watched converging while a survey runs.
+	Each observation costs O(terms^2).
+	'''
+	def __init__(self,terms=DEFAULT_TERMS,prior=1e8,window=20,tolerance=1.0):
+		'''
+		prior: initial variance of every term (arcsec^2), large means uninformed
+		window,tolerance: converged() once no term moved more than
+		                  tolerance arcsec over the last window observations
+		'''
+		self.terms = list(terms)
+		self.values = np.zeros(len(self.terms))
+		self.P = np.eye(len(self.terms))*prior
+		self.n = 0
+		self.rss = 0.0
+		self.window = window
+		self.tolerance = tolerance
+		self.history = deque(maxlen=window+1)
+		self._lock = threading.Lock()
+
+	def update(self,data):
+		'''
+		Add observations (parse_tpoint/from_index style data, any length).
+		Observations with a non-finite value are skipped: one NaN would
+		stay in the state for good.
+		'''
+		A = design_matrix(self.terms,data['ha_obs'],data['dec_obs'],data['lat'])
+		y = offsets(data)
+		n = len(y)//2
+		good = np.isfinite(y[:n]) & np.isfinite(y[n:]) & np.isfinite(A[:n]).all(axis=1) & np.isfinite(A[n:]).all(axis=1)
+		with self._lock:
+			for i in np.flatnonzero(good):
+				for row in (i,n+i):
+					a = A[row]
+					Pa = np.dot(self.P,a)
+					s = 1.0+np.dot(a,Pa)
+					k = Pa/s
+					e = y[row]-np.dot(a,self.values)
+					self.values += k*e
+					self.P -= np.outer(k,Pa)
+					self.rss += e*e/s
+				self.n += 1
+				self.history.append(self.values.copy())
+
+	def converged(self):
+		with self._lock:
+			if self.n < 2*len(self.terms) or len(self.history) <= self.window:
+				return False
+			change = np.abs(self.history[-1]-self.history[0]).max()
+			return change < self.tolerance
+
+	def model(self):
+		'''
+		Current fit in the same form solve_tpoint returns (without residuals).
+		'''
+		with self._lock:
+			dof = max(2*self.n-len(self.terms),1)
+			return {
+				'terms':list(self.terms),
+				'values':self.values.copy(),
+				'sigmas':np.sqrt(np.diag(self.P)*self.rss/dof),
+				'rms':np.sqrt(self.rss/self.n) if self.n else 0.0,
+				'n':self.n}
+
+	def summary(self):
+		model = self.model()
+		terms = ' '.join('%s=%.1f' % (t,v) for t,v in zip(model['terms'],model['values']))
+		return 'n=%d rms=%.2f %s' % (model['n'],model['rms'],terms)
+
+class CorrectionGrid(object):
+	'''
+	A fitted model compiled into a dense hour angle/Dec table, so applying
+	it to many targets is a few array lookups per point (bilinear
+	interpolation) instead of evaluating every term.
+
+	The grid is refined until the interpolation error, measured against
+	the analytic model at random points, is below tolerance (arcsec).
+	Positions outside dec_range are clamped to its edge.
+	'''
+	def __init__(self,model,lat,step=1.0,dec_range=(-85,85),tolerance=0.5,min_step=0.125,samples=20000):
+		self.model = model
+		self.lat = lat
+		self.dec_range = dec_range
+		while True:
+			self._build(step)
+			self.max_error = self.error(samples)
+			if self.max_error <= tolerance or step/2 < min_step:
+				break
+			step /= 2.0
+
+	def _build(self,step):
+		self.step = step
+		self.ha = np.arange(-180,180+step,step)
+		self.dec = np.arange(self.dec_range[0],self.dec_range[1]+step,step)
+		H,D = np.meshgrid(self.ha,self.dec,indexing='ij')
+		dh,dd = evaluate(self.model,H.ravel(),D.ravel(),self.lat)
+		# hour angle offsets kept in hour angle units, ready to add
+		self.dh = (dh/np.cos(np.deg2rad(D.ravel()))).reshape(H.shape)
+		self.dd = dd.reshape(H.shape)
+
+	def offsets(self,ha,dec):
+		'''
+		Model offsets at the given positions (deg): arcsec of hour angle and
+		arcsec of Dec.
+		'''
+		ha = (np.asarray(ha,dtype=float)+180) % 360 - 180
+		dec = np.clip(np.asarray(dec,dtype=float),self.dec[0],self.dec[-1])
+		x = (ha-self.ha[0])/self.step
+		y = (dec-self.dec[0])/self.step
+		i = np.clip(x.astype(int),0,len(self.ha)-2)
+		j = np.clip(y.astype(int),0,len(self.dec)-2)
+		t = x-i
+		u = y-j
+		out = []
+		for g in (self.dh,self.dd):
+			out.append((1-t)*(1-u)*g[i,j]+t*(1-u)*g[i+1,j]+(1-t)*u*g[i,j+1]+t*u*g[i+1,j+1])
+		return out[0],out[1]
+
+	def correct(self,ha,dec):
+		'''
+		Where to point the mount (ha,dec in deg) to land on the given targets.
+		'''
+		dh,dd = self.offsets(ha,dec)
+		return np.asarray(ha)+dh/3600.0,np.asarray(dec)+dd/3600.0
+
+	def error(self,samples=20000,seed=0):
+		'''
+		Largest difference (arcsec on the sky) between the grid and the
+		analytic model over random positions in range.
+		'''
+		r = np.random.RandomState(seed)
+		ha = r.uniform(-180,180,samples)
+		dec = r.uniform(self.dec[0],self.dec[-1],samples)
+		dh,dd = evaluate(self.model,ha,dec,self.lat)
+		gh,gd = self.offsets(ha,dec)
+		return max(np.abs(gh*np.cos(np.deg2rad(dec))-dh).max(),np.abs(gd-dd).max())
+
+def report(model):
+	'''
+	Format a fitted model as a TPOINT style table.
 	'''
+	lines = ['%-8s %12s %10s' % ('term','value','sigma')]
+	for name,value,sigma in zip(model['terms'],model['values'],model['sigmas']):
+		lines.append('%-8s %12.2f %10.3f' % (name,value,sigma))
+	lines.append('%d observations, sky RMS = %.2f arcsec' % (model['n'],model['rms']))
+	return '\n'.join(lines)
 
 
 if __name__ == "__main__":
-	pass
\ No newline at end of file
+	import sys
+	print report(solve_tpoint(sys.argv[1]))
@@ -0,0 +1,37 @@
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+'''
+Helpers for handing large numpy arrays to a process pool without copying
+them into every task.  Arrays are copied once into shared memory and
+passed to the pool initializer; workers attach() a numpy view.
+'''
+
+def share(array):
+	'''
+	Copy a float array into shared memory, returns a handle for attach().
+	'''
+	array = np.ascontiguousarray(array,dtype=np.float64)
+	raw = RawArray('d',max(array.size,1))
+	np.frombuffer(raw,dtype=np.float64)[:array.size] = array.ravel()
+	return raw,array.shape
+
+def attach(handle):
+	'''
+	Numpy view of a shared array, no copy.
+	'''
+	raw,shape = handle
+	size = int(np.prod(shape))
+	return np.frombuffer(raw,dtype=np.float64)[:size].reshape(shape)
+
+def processes(n=None):
+	'''
+	Number of worker processes to use, default one per core.
+	'''
+	if n is None:
+		n = multiprocessing.cpu_count()
+	return max(int(n),1)
+
+def pool(n,initializer,initargs):
+	return multiprocessing.Pool(processes(n),initializer,initargs)
@@ -12,7 +12,46 @@ def azel2xyz(az,el):
 	z = np.sin(np.deg2rad(el))
 	return x,y,z
 
-def PolePolygon(P,output='2d'):
+# overlay geometry, keyed by function, config values and (for sky-fixed
+# overlays) the UTC minute
+_overlays = {}
+
+def cached(f):
+	'''
+	Memoize an overlay function of hashable arguments.  Results are shared
+	between figures, so callers must not modify them.
+	'''
+	def wrapper(*args):
+		key = (f.__name__,)+args
+		if key not in _overlays:
+			if len(_overlays) > 256:
+				_overlays.clear()
+			_overlays[key] = f(*args)
+		return _overlays[key]
+	wrapper.__name__ = f.__name__
+	wrapper.__doc__ = f.__doc__
+	return wrapper
+
+def _minute(dt=None):
+	dt = dt or datetime.utcnow()
+	return dt.replace(second=0,microsecond=0)
+
+@cached
+def _pole_ring(pole_buffer,lat,lon,minute):
+	'''
+	Az/el of the circle pole_buffer degrees from the pole, one point per
+	degree of RA.
+	'''
+	return geometry.RaDec2AzEl_many(minute,np.arange(0,360),90-pole_buffer,lat,lon)
+
+@cached
+def _pole_polygons(pole_buffer,lat,lon,minute):
+	paz,pel = _pole_ring(pole_buffer,lat,lon,minute)
+	low = np.column_stack((np.where(paz <= 180,paz,paz-360),pel))
+	high = np.column_stack((np.where(paz <= 180,paz+360,paz),pel))
+	return low,high
+
+def PolePolygon(P,output='2d',dt=None):
 	'''
 	Generate two polygon patches dpicting a ring around the celestial pole
 	in az/el space.  Produce two, one at zero, one at 360 azimuth
@@ -21,33 +60,14 @@ def PolePolygon(P,output='2d'):
 	pole_buffer = P['survey']['buffers']['pole']
 	lat = P['location']['lat']
 	lon = P['location']['lon']
-	dt = datetime.now()
+	minute = _minute(dt)
 	if output == '2d':
-		low_pole_points = []
-		high_pole_points = []
-		for ra in range(0,360):
-			paz,pel = geometry.RaDec2AzEl(dt,ra,90-pole_buffer,lat,lon)
-			if paz <= 180:
-				low_pole_points.append(paz)
-				high_pole_points.append(paz+360)
-			if paz > 180:
-				low_pole_points.append(paz-360)
-				high_pole_points.append(paz)
-			low_pole_points.append(pel)
-			high_pole_points.append(pel)
-		low_pole_points = np.reshape(low_pole_points,(len(low_pole_points)/2,2))
-		high_pole_points = np.reshape(high_pole_points,(len(high_pole_points)/2,2))
+		low_pole_points,high_pole_points = _pole_polygons(pole_buffer,lat,lon,minute)
 		low_pole_patch = matplotlib.patches.Polygon(low_pole_points,ec="b",fill=None,label='Pole Buffer ('+str(pole_buffer)+' deg)')
 		high_pole_patch = matplotlib.patches.Polygon(high_pole_points,ec="b",fill=None)
 		return low_pole_patch, high_pole_patch
 	elif output == '3d':
-		az = []
-		el = []
-		for ra in range(0,360):
-			paz,pel = geometry.RaDec2AzEl(dt,ra,90-pole_buffer,lat,lon)
-			az.append(paz)
-			el.append(pel)
-		return az,el
+		return _pole_ring(pole_buffer,lat,lon,minute)
 
 def ElevationLimit(P,output='2d'):
 	min_el = P['survey']['masks']['include']['elevation'][0]
@@ -56,12 +76,7 @@ def ElevationLimit(P,output='2d'):
 		el = [min_el,min_el]
 		return az, el
 	if output == '3d':
-		el_list = []
-		az_list = []
-		for az in range(0,360):
-			el_list.append(min_el)
-			az_list.append(az)
-		return az_list,el_list
+		return _ring(min_el)
 
 def LocalHorrizon(P,output='2d'):
 	if output == '2d':
@@ -69,12 +84,20 @@ def LocalHorrizon(P,output='2d'):
 		el = [0,0]
 		return az, el
 	if output == '3d':
-		el_list = []
-		az_list = []
-		for az in range(0,360):
-			el_list.append(0)
-			az_list.append(az)
-		return az_list,el_list
+		return _ring(0)
+
+@cached
+def _ring(el):
+	'''
+	Circle of constant elevation, one point per degree of azimuth.
+	'''
+	return np.arange(0,360),np.full(360,el)
+
+@cached
+def _meridian_3d():
+	az = np.concatenate((np.zeros(90),np.full(90,180)))
+	el = np.concatenate((np.arange(0,90),np.arange(90,0,-1)))
+	return az,el
 
 def MeridianLine(P,output='2d'):
 	
@@ -83,115 +106,91 @@ def MeridianLine(P,output='2d'):
 		el = [0,90]
 		return az, el
 	if output == '3d':
-		el_list = []
-		az_list = []
-		for el in range(0,90):
-			el_list.append(el)
-			az_list.append(0)
-		for el in range(90,0,-1):
-			el_list.append(el)
-			az_list.append(180)
-		return az_list,el_list
+		return _meridian_3d()
 
 def MeridianBuffer(P,output='2d'):
-	meridian_buffer = P['survey']['buffers']['meridian']
+	return _meridian_buffer(P['survey']['buffers']['meridian'],output)
+
+@cached
+def _meridian_buffer(meridian_buffer,output):
 	if output == '3d':
-		az = [[],[]]
-		el = [[],[]]
-		for e in range(0,180):
-			# one way..
-			raz,rel = geometry.meridian_rotate(0,e,meridian_buffer)
-			el[0].append(rel)
-			az[0].append(raz)
-			# then the other
-			raz,rel = geometry.meridian_rotate(0,e,-meridian_buffer)
-			el[1].append(rel)
-			az[1].append(raz)
-		return az, el
+		# one way, then the other
+		e = np.arange(0,180)
+		raz,rel = geometry.meridian_rotate_many(0,e,[[meridian_buffer],[-meridian_buffer]])
+		return list(raz), list(rel)
 
 	if output == '2d':
-		az = [[],[],[],[]]
-		el = [[],[],[],[]]
-		start_az = [180,180,0,360]
-		theta_list = [meridian_buffer,-meridian_buffer,meridian_buffer,-meridian_buffer]
-		for i,a in enumerate(start_az):
-			for e in range(0,91):
-				raz,rel = geometry.meridian_rotate(a,e,theta_list[i])
-				if raz < 0:
-					raz = raz + 360
-				el[i].append(rel)
-				az[i].append(raz)
-		return az,el
+		e = np.arange(0,91)
+		start_az = np.array([[180],[180],[0],[360]])
+		theta_list = np.array([[meridian_buffer],[-meridian_buffer],[meridian_buffer],[-meridian_buffer]])
+		raz,rel = geometry.meridian_rotate_many(start_az,e,theta_list)
+		raz = np.where(raz < 0,raz+360,raz)
+		return list(raz), list(rel)
 
-def Plot2D(az,el,P,my_line_style='None',save_path=None):
+# figure sizes (inches)
+SIZE_2D = (16,6.5)
+SIZE_3D = (16,16)
+
+def Dpi(P):
 	'''
-	Plot survey data in 2D
+	Output resolution, P['plot']['dpi'] if given.
+	'''
+	return P.get('plot',{}).get('dpi',400)
+
+def Draw2D(fig,az,el,P,my_line_style='None'):
+	'''
+	Draw survey data in 2D onto fig, without touching pyplot state.
 	'''
 	# Get values from config:
 	meridian_buffer = P['survey']['buffers']['meridian']
-	pole_buffer = P['survey']['buffers']['pole']
 	min_el = P['survey']['masks']['include']['elevation'][0]
-	lat = P['location']['lat']
-	lon = P['location']['lon']
 
-	# specify figure size:
-	fig = plt.figure(figsize=(16,6.5))
 	ax = fig.add_subplot(111)
-	plt.tight_layout()
+	fig.tight_layout()
 
 	# plot meridian :
 	x,y =MeridianLine(P)
-	handle_meridian = plt.plot(x,y,color='red',linestyle='-',marker='None',label='Local Meridian')
+	ax.plot(x,y,color='red',linestyle='-',marker='None',label='Local Meridian')
 
 	# plot meridian boundary:	
 	x,y = MeridianBuffer(P)
-	plt.plot(x[0],y[0],color='red',linestyle='--',marker='None',label='Meridian Buffer ('+str(meridian_buffer)+' deg)')
-	plt.plot(x[1],y[1],color='red',linestyle='--',marker='None')
-	plt.plot(x[2],y[2],color='red',linestyle='--',marker='None')
-	plt.plot(x[3],y[3],color='red',linestyle='--',marker='None')
+	ax.plot(x[0],y[0],color='red',linestyle='--',marker='None',label='Meridian Buffer ('+str(meridian_buffer)+' deg)')
+	ax.plot(x[1],y[1],color='red',linestyle='--',marker='None')
+	ax.plot(x[2],y[2],color='red',linestyle='--',marker='None')
+	ax.plot(x[3],y[3],color='red',linestyle='--',marker='None')
 
 	# plot minimum elevation:
 	x,y = ElevationLimit(P) 
-	handle_elevation_limit = plt.plot(x,y,color='green',linestyle='--',marker='None',label='Minimum Elevation ('+str(min_el)+' deg)')
+	ax.plot(x,y,color='green',linestyle='--',marker='None',label='Minimum Elevation ('+str(min_el)+' deg)')
 	
 	# plot pole boundary:
-	ax = plt.gca()
 	lowpatch,hipatch = PolePolygon(P)
 	ax.add_patch(lowpatch)
 	ax.add_patch(hipatch)
 	
 	# plot the survey points:
-	plt.plot(az,el,linestyle=my_line_style,marker='+')
+	points = ax.plot(az,el,linestyle=my_line_style,marker='+')[0]
 	
 	# Make it nice
-	plt.axis('scaled')
-	if lat >= 0:
-		plt.axis([0,360,0,90])
-	else:
-		plt.axis([0,360,0,90])
-	plt.ylabel('Elevation (deg)')
-	plt.xlabel('Azimuth (deg)')
-	plt.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,ncol=2, mode="expand", borderaxespad=0.)
-	if save_path:
-		plt.savefig(save_path,bbox_inches='tight',dpi=400)
-	else:
-		plt.show()
+	ax.axis('scaled')
+	ax.axis([0,360,0,90])
+	ax.set_ylabel('Elevation (deg)')
+	ax.set_xlabel('Azimuth (deg)')
+	ax.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,ncol=2, mode="expand", borderaxespad=0.)
+	return ax,points
 
-def Plot3D(az,el,P,my_line_style='None',save_path=None):
+def Draw3D(fig,az,el,P,my_line_style='None'):
 	'''
-	plot sruvey data in 3D
+	Draw survey data in 3D onto fig, without touching pyplot state.
 	'''
 	from mpl_toolkits.mplot3d import Axes3D
 
 	meridian_buffer = P['survey']['buffers']['meridian']
 	pole_buffer = P['survey']['buffers']['pole']
 	min_el = P['survey']['masks']['include']['elevation'][0]
-	lat = P['location']['lat']
-	lon = P['location']['lon']
 
-	fig = plt.figure(figsize=(16,16))
 	ax = fig.add_subplot(111, projection='3d')
-	plt.tight_layout()
+	fig.tight_layout()
 
 	# plot the survey points
 	x,y,z = geometry.azel2xyz(az,el)
@@ -232,11 +231,173 @@ def Plot3D(az,el,P,my_line_style='None',save_path=None):
 	ax.set_xticklabels([])
 	ax.set_yticklabels([])
 	ax.view_init(elev=20, azim=-40)
-	plt.axis('off')
-	plt.legend(mode="expand", borderaxespad=0.)
+	ax.set_axis_off()
+	ax.legend(mode="expand", borderaxespad=0.)
+	return ax
 
-	# output
+def Plot2D(az,el,P,my_line_style='None',save_path=None):
+	'''
+	Plot survey data in 2D
+	'''
+	fig = plt.figure(figsize=SIZE_2D)
+	Draw2D(fig,az,el,P,my_line_style)
+	if save_path:
+		fig.savefig(save_path,bbox_inches='tight',dpi=Dpi(P))
+		plt.close(fig)
+	else:
+		plt.show()
+
+def Plot3D(az,el,P,my_line_style='None',save_path=None):
+	'''
+	plot sruvey data in 3D
+	'''
+	fig = plt.figure(figsize=SIZE_3D)
+	Draw3D(fig,az,el,P,my_line_style)
+	if save_path:
+		fig.savefig(save_path,bbox_inches='tight',dpi=Dpi(P))
+		plt.close(fig)
+	else:
+		plt.show()
+
+def BinResiduals(x,y,dx,dy,step=10.0,x_range=(0,360),y_range=(0,90)):
+	'''
+	Aggregate residuals (dx,dy, arcsec) at sky positions (x,y, deg) into
+	step x step degree bins.  Returns bin edges and per-bin count, mean
+	residual vector and RMS (nan where empty).
+	'''
+	x,y,dx,dy = [np.asarray(v,dtype=float) for v in (x,y,dx,dy)]
+	ok = np.isfinite(x) & np.isfinite(y) & np.isfinite(dx) & np.isfinite(dy)
+	x,y,dx,dy = x[ok],y[ok],dx[ok],dy[ok]
+	bins = (np.arange(x_range[0],x_range[1]+step/2.0,step),np.arange(y_range[0],y_range[1]+step/2.0,step))
+	total = lambda w: np.histogram2d(x,y,bins=bins,weights=w)[0]
+	count,xedges,yedges = np.histogram2d(x,y,bins=bins)
+	with np.errstate(invalid='ignore',divide='ignore'):
+		mean_dx = total(dx)/count
+		mean_dy = total(dy)/count
+		rms = np.sqrt(total(dx**2+dy**2)/count)
+	return {'x':xedges,'y':yedges,'count':count,'dx':mean_dx,'dy':mean_dy,'rms':rms}
+
+def _azel_residuals(table):
+	'''
+	Residuals (arcsec, solved minus reported) rotated into az/el: both
+	positions are taken to az/el through the hour angle at the frame's
+	sidereal time, the J2000 solution after precessing it to date.
+	'''
+	solved_ra,solved_dec = geometry.precess_to_date(table['utc'],table['solved_ra'],table['solved_dec'])
+	az,el = geometry.HaDec2AzEl_many(table['lst']-table['ra'],table['dec'],table['lat'])
+	solved_az,solved_el = geometry.HaDec2AzEl_many(table['lst']-solved_ra,solved_dec,table['lat'])
+	d_az = ((solved_az-az+180) % 360 - 180)*np.cos(np.deg2rad(el))*3600
+	return d_az,(solved_el-el)*3600
+
+def DrawResidualMap(fig,table,coords='azel',step=10.0):
+	'''
+	Draw binned residuals of an index table onto fig: mean residual vectors
+	and RMS per bin, in az/el or hour angle/Dec.  Drawing cost depends on
+	the number of bins, not observations.
+	'''
+	use = ~np.asarray(table['rejected'],dtype=bool)
+	table = dict((k,np.asarray(v)[use]) for k,v in table.items())
+	if coords == 'azel':
+		x,y = table['cmd_az'],table['cmd_el']
+		dx,dy = _azel_residuals(table)
+		x_range,y_range,labels = (0,360),(0,90),('Azimuth (deg)','Elevation (deg)')
+	else:
+		x = (table['lst']-table['ra']+180) % 360 - 180
+		y = table['dec']
+		# hour angle runs opposite to right ascension
+		dx,dy = -table['d_ra'],table['d_dec']
+		x_range,y_range,labels = (-180,180),(-90,90),('Hour Angle (deg)','Declination (deg)')
+	b = BinResiduals(x,y,dx,dy,step,x_range,y_range)
+	cx = (b['x'][1:]+b['x'][:-1])/2
+	cy = (b['y'][1:]+b['y'][:-1])/2
+	X,Y = np.meshgrid(cx,cy,indexing='ij')
+	full = b['count'] > 0
+
+	ax = fig.add_subplot(211)
+	arrows = ax.quiver(X[full],Y[full],b['dx'][full],b['dy'][full],angles='xy',pivot='middle')
+	if full.any():
+		# reference arrow of a round length near the typical residual
+		key = float('%.1g' % max(np.median(np.hypot(b['dx'][full],b['dy'][full])),0.1))
+		ax.quiverkey(arrows,0.9,1.05,key,'%g arcsec' % key,labelpos='E')
+	ax.set_title('Mean residual (%d frames)' % len(x))
+	ax2 = fig.add_subplot(212)
+	mesh = ax2.pcolormesh(b['x'],b['y'],np.ma.masked_invalid(b['rms']).T)
+	fig.colorbar(mesh,ax=ax2,label='RMS (arcsec)')
+	ax2.set_title('RMS residual')
+	for a in (ax,ax2):
+		a.axis([x_range[0],x_range[1],y_range[0],y_range[1]])
+		a.set_aspect('equal')
+		a.set_xlabel(labels[0])
+		a.set_ylabel(labels[1])
+	return b
+
+def ResidualMap(table,P,coords='azel',step=10.0,save_path=None):
+	'''
+	Plot binned pointing residuals from an index table
+	'''
+	fig = plt.figure(figsize=(16,9))
+	DrawResidualMap(fig,table,coords,step)
 	if save_path:
-		plt.savefig(save_path,bbox_inches='tight',dpi=400)
+		fig.savefig(save_path,bbox_inches='tight',dpi=Dpi(P))
+		plt.close(fig)
 	else:
 		plt.show()
+
+class LivePlot2D(object):
+	'''
+	Survey progress on the Plot2D layout, updated one frame at a time.
+
+	The overlays and planned points are drawn once and kept as a saved
+	background.  Each update draws only the new path segment and point on
+	top of it, saves that as the new background, then blits the current
+	position marker, so the cost per frame does not grow with the number
+	of frames done.  The window is driven with flush_events, pyplot's
+	interactive mode is left alone for the figures drawn after it.
+	'''
+	def __init__(self,az,el,P):
+		self.fig = plt.figure(figsize=SIZE_2D)
+		self.ax,planned = Draw2D(self.fig,az,el,P)
+		planned.set_color('0.7')
+		self.done = ([],[])
+		self._path = self.ax.plot([],[],color='black',linestyle='-',linewidth=0.5,marker='None',animated=True)[0]
+		self._points = self.ax.plot([],[],color='black',linestyle='None',marker='+',animated=True)[0]
+		self._current = self.ax.plot([],[],color='orange',linestyle='None',marker='o',markersize=10,animated=True)[0]
+		self._background = None
+		self.fig.canvas.mpl_connect('draw_event',self._redraw)
+		plt.show(block=False)
+		self.fig.canvas.draw()
+		self.fig.canvas.flush_events()
+
+	def _redraw(self,event=None):
+		'''
+		Full redraw (first show, resize): put everything done back on top of
+		the fresh background.  This is the only place the cost grows with
+		the number of frames done.
+		'''
+		self._path.set_data(*self.done)
+		self._points.set_data(*self.done)
+		self.ax.draw_artist(self._path)
+		self.ax.draw_artist(self._points)
+		self._background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+
+	def update(self,az,el):
+		'''
+		Add a completed frame at az/el and mark it as the current position.
+		'''
+		canvas = self.fig.canvas
+		canvas.restore_region(self._background)
+		if self.done[0]:
+			self._path.set_data([self.done[0][-1],az],[self.done[1][-1],el])
+			self.ax.draw_artist(self._path)
+		self._points.set_data([az],[el])
+		self.ax.draw_artist(self._points)
+		self._background = canvas.copy_from_bbox(self.ax.bbox)
+		self.done[0].append(az)
+		self.done[1].append(el)
+		self._current.set_data([az],[el])
+		self.ax.draw_artist(self._current)
+		canvas.blit(self.ax.bbox)
+		canvas.flush_events()
+
+	def close(self):
+		plt.close(self.fig)
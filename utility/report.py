@@ -0,0 +1,54 @@
+import os
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import plot
+import parallel
+
+'''
+Headless survey figures.
+
+Figures are drawn on matplotlib's object oriented Agg API (no pyplot state,
+no display), so several can be rendered at once in worker processes.
+Resolution comes from P['plot']['dpi'].
+'''
+
+DRAW = {
+	'2d':(plot.Draw2D,plot.SIZE_2D),
+	'3d':(plot.Draw3D,plot.SIZE_3D),
+	}
+
+def render(task):
+	'''
+	Render one (kind,az,el,P,line_style,path) task, returns the path.
+	'''
+	kind,az,el,P,line_style,path = task
+	draw,size = DRAW[kind]
+	fig = Figure(figsize=size)
+	FigureCanvasAgg(fig)
+	draw(fig,az,el,P,line_style)
+	fig.savefig(path,bbox_inches='tight',dpi=plot.Dpi(P))
+	return path
+
+def survey_figures(P,az,el,directory,prefix=''):
+	'''
+	Tasks for the standard set: survey points and the slew path, 2D and 3D.
+	'''
+	name = lambda n: os.path.join(directory,prefix+n+'.png')
+	return [
+		('2d',az,el,P,'none',name('survey_2D')),
+		('3d',az,el,P,'none',name('survey_3D')),
+		('2d',az,el,P,'-',name('tsp_2D')),
+		('3d',az,el,P,'-',name('tsp_3D'))]
+
+def render_all(tasks,processes=None):
+	'''
+	Render tasks on a process pool (one per core by default), returns the
+	paths written.
+	'''
+	if parallel.processes(processes) == 1 or len(tasks) < 2:
+		return map(render,tasks)
+	workers = parallel.pool(min(parallel.processes(processes),len(tasks)),None,())
+	try:
+		return workers.map(render,tasks,chunksize=1)
+	finally:
+		workers.terminate()
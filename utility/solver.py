@@ -0,0 +1,312 @@
+import time
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from api import astrometry
+from cache import SolutionCache,default_path
+import timing
+
+'''
+Keep many astrometry.net submissions in flight at once.
+
+Uploads run on a small thread pool, bounded by "max_in_flight".  A single
+polling thread checks every outstanding submission/job in batches, backing
+off exponentially on each job that hasn't changed state.  Frames whose
+pixels were solved before are answered from the SolutionCache without
+touching the network.
+'''
+
+# job states:
+QUEUED = 'queued'
+SUBMITTED = 'submitted'
+SOLVING = 'solving'
+SUCCESS = 'success'
+FAILURE = 'failure'
+STATES = (QUEUED,SUBMITTED,SOLVING,SUCCESS,FAILURE)
+
+class SolveJob(object):
+	'''
+	One FITS file on its way through astrometry.net
+	'''
+	def __init__(self,path,kwargs):
+		self.path = path
+		self.kwargs = kwargs
+		self.state = QUEUED
+		self.sub_id = None
+		self.job_id = None
+		self.calibration = None
+		self.hash = None
+		self.cached = False
+		self.error = None
+		self.submitted = None
+		self.finished = None
+		self.interval = 0
+		self.next_poll = 0
+		self._done = threading.Event()
+
+	def done(self):
+		return self._done.is_set()
+
+	def wait(self,timeout=None):
+		'''
+		Block until the job succeeds or fails, returns the job.
+		'''
+		self._done.wait(timeout)
+		return self
+
+class SolveManager(object):
+	'''
+	Submit FITS files to astrometry.net and track them until solved.
+
+	Settings are read from P['astrometry']['solver'] (all optional):
+		max_in_flight: submissions uploaded but not yet finished (default 8)
+		   poll_batch: most status requests per polling round (default 32)
+		     poll_min: first poll interval in seconds (default 2)
+		     poll_max: backoff ceiling in seconds (default 60)
+		      timeout: give up on a submission after this many seconds (default 900)
+	   retry_failures: re-submit frames cached as unsolvable (default false)
+
+	Pass cache=False to skip the solution cache.
+	'''
+	def __init__(self,P,client=None,callback=None,cache=None):
+		api = P['astrometry']['api']
+		settings = P['astrometry'].get('solver',{})
+		self.max_in_flight = settings.get('max_in_flight',8)
+		self.poll_batch = settings.get('poll_batch',32)
+		self.poll_min = float(settings.get('poll_min',2))
+		self.poll_max = float(settings.get('poll_max',60))
+		self.timeout = settings.get('timeout',900)
+		self.retry_failures = settings.get('retry_failures',False)
+		if cache is None and 'files' in P:
+			cache = SolutionCache(default_path(P))
+		self.cache = cache
+		if client is None:
+			client = astrometry.Client(api['api_url'])
+			client.login(api['key'])
+		self.client = timing.instrument(client,('upload','sub_status','job_status','job_calibration'),'astrometry')
+		self.callbacks = []
+		if callback:
+			self.callbacks.append(callback)
+		self._lock = threading.Lock()
+		self._idle = threading.Condition(self._lock)
+		self._wake = threading.Event()
+		self._stop = threading.Event()
+		self._queue = deque()
+		self._in_flight = []
+		self._counts = dict((s,0) for s in STATES)
+		self._uploads = ThreadPool(self.max_in_flight)
+		self._polls = ThreadPool(min(self.max_in_flight,self.poll_batch))
+		self._thread = threading.Thread(target=self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def add_callback(self,callback):
+		'''
+		callback(job) is called once for every job that finishes
+		'''
+		self.callbacks.append(callback)
+
+	def remove_callback(self,callback):
+		if callback in self.callbacks:
+			self.callbacks.remove(callback)
+
+	def submit(self,path,**kwargs):
+		'''
+		Queue a FITS file for solving.  Returns immediately with a SolveJob,
+		extra keywords are passed on to astrometry.Client.upload
+		'''
+		job = SolveJob(path,kwargs)
+		with self._lock:
+			self._queue.append(job)
+			self._counts[QUEUED] += 1
+		self._wake.set()
+		return job
+
+	def solve(self,path,**kwargs):
+		'''
+		Submit a FITS file and block until it finishes.
+		'''
+		return self.submit(path,**kwargs).wait()
+
+	def progress(self):
+		'''
+		Return the number of jobs in each state, plus the total.
+		'''
+		with self._lock:
+			counts = dict(self._counts)
+		counts['total'] = sum(counts.values())
+		return counts
+
+	def join(self,timeout=None):
+		'''
+		Wait until every submitted job has finished.
+		'''
+		end = None if timeout is None else time.time()+timeout
+		with self._lock:
+			while self._queue or self._in_flight:
+				if end is not None and time.time() >= end:
+					return False
+				self._idle.wait(1.0)
+		return True
+
+	def wait_capacity(self,timeout=None):
+		'''
+		Wait until a new submission would start uploading straight away,
+		i.e. fewer than max_in_flight jobs are queued or in flight.  Returns
+		False if the timeout ran out first.
+		'''
+		end = None if timeout is None else time.time()+timeout
+		with self._lock:
+			while len(self._queue)+len(self._in_flight) >= self.max_in_flight:
+				if end is not None and time.time() >= end:
+					return False
+				self._idle.wait(1.0)
+		return True
+
+	def close(self):
+		self._stop.set()
+		self._wake.set()
+		self._thread.join()
+		self._uploads.terminate()
+		self._polls.terminate()
+
+	def _set_state(self,job,state):
+		with self._lock:
+			self._counts[job.state] -= 1
+			self._counts[state] += 1
+			job.state = state
+
+	def _finish(self,job,state,error=None):
+		job.error = error
+		job.finished = time.time()
+		if self.cache and job.hash and not job.cached and (state == SUCCESS or error == 'no solution'):
+			try:
+				self.cache.put(job.hash,state,job.calibration,job.job_id,error,job.path)
+			except Exception as e:
+				# the result still counts, it just isn't remembered
+				print "Could not cache solution for",job.path,":",e
+		with self._lock:
+			self._counts[job.state] -= 1
+			self._counts[state] += 1
+			job.state = state
+			if job in self._in_flight:
+				self._in_flight.remove(job)
+			self._idle.notify_all()
+		job._done.set()
+		self._wake.set()
+		for callback in self.callbacks:
+			try:
+				callback(job)
+			except Exception as e:
+				print "Solve callback failed for",job.path,":",e
+
+	def _backoff(self,job,reset=False):
+		if reset:
+			job.interval = self.poll_min
+		else:
+			job.interval = min(job.interval*2,self.poll_max)
+		job.next_poll = time.time()+job.interval
+
+	def _dispatch(self):
+		'''
+		Start uploads until the in-flight limit is reached.
+		'''
+		with self._lock:
+			while self._queue and len(self._in_flight) < self.max_in_flight:
+				job = self._queue.popleft()
+				self._in_flight.append(job)
+				self._uploads.apply_async(self._upload,(job,))
+
+	def _upload(self,job):
+		'''
+		Runs on the upload pool, which drops exceptions silently: anything
+		escaping here would leave the job in flight for good.
+		'''
+		try:
+			if self.cache and self._from_cache(job):
+				return
+			result = self.client.upload(job.path,**job.kwargs)
+		except Exception as e:
+			self._finish(job,FAILURE,'upload failed: %s' % e)
+			return
+		if not result or result.get('status') != 'success':
+			self._finish(job,FAILURE,'upload failed: %s' % result)
+			return
+		job.sub_id = result['subid']
+		job.submitted = time.time()
+		self._backoff(job,reset=True)
+		self._set_state(job,SUBMITTED)
+		self._wake.set()
+
+	def _from_cache(self,job):
+		'''
+		Finish the job from a previous solution of the same pixels, if any.
+		'''
+		try:
+			job.hash = self.cache.hash(job.path)
+		except (IOError,ValueError) as e:
+			self._finish(job,FAILURE,'unreadable: %s' % e)
+			return True
+		hit = self.cache.get(job.hash)
+		if hit is None or (hit['status'] == FAILURE and self.retry_failures):
+			return False
+		job.cached = True
+		job.calibration = hit['calibration']
+		job.job_id = hit['job_id']
+		self._finish(job,hit['status'],hit['error'])
+		return True
+
+	def _due(self):
+		'''
+		Return the next batch of jobs whose poll time has arrived.
+		'''
+		now = time.time()
+		with self._lock:
+			due = [j for j in self._in_flight if j.state in (SUBMITTED,SOLVING) and j.next_poll <= now]
+		due.sort(key=lambda j: j.next_poll)
+		return due[:self.poll_batch]
+
+	def _poll(self,job):
+		if time.time()-job.submitted > self.timeout:
+			self._finish(job,FAILURE,'timed out')
+			return
+		try:
+			if job.job_id is None:
+				stat = self.client.sub_status(job.sub_id,justdict=True)
+				jobs = [j for j in stat.get('jobs',[]) if j is not None]
+				if jobs:
+					job.job_id = jobs[0]
+					self._set_state(job,SOLVING)
+					self._backoff(job,reset=True)
+				else:
+					self._backoff(job)
+				return
+			stat = self.client.job_status(job.job_id,justdict=True)
+			status = stat.get('status')
+			if status == 'success':
+				job.calibration = self.client.job_calibration(job.job_id)
+				self._finish(job,SUCCESS)
+			elif status == 'failure':
+				self._finish(job,FAILURE,'no solution')
+			else:
+				self._backoff(job)
+		except Exception:
+			# network hiccups are retried on the next round
+			self._backoff(job)
+
+	def _sleep_time(self):
+		with self._lock:
+			times = [j.next_poll for j in self._in_flight if j.state in (SUBMITTED,SOLVING)]
+		if not times:
+			return self.poll_max
+		return min(max(min(times)-time.time(),0.05),self.poll_max)
+
+	def _run(self):
+		while not self._stop.is_set():
+			self._wake.clear()
+			self._dispatch()
+			due = self._due()
+			if due:
+				self._polls.map(self._poll,due)
+				continue
+			self._wake.wait(self._sleep_time())
@@ -0,0 +1,44 @@
+from StringIO import StringIO
+import numpy as np
+from utility import export, mount_model
+
+def test_formatting_carries():
+	assert export._ra([359.99999999]) == ['00 00 00.00']
+	assert export._dec([-0.5,89.99999999]) == ['-00 30 00.0','+90 00 00.0']
+	assert export._lst([15.0*23.99999]) == ['00 00.00']
+
+def test_round_trip():
+	r = np.random.RandomState(0)
+	n = 50
+	lst = r.uniform(0,360,n)
+	ra = r.uniform(0,360,n)
+	dec = r.uniform(-30,85,n)
+	table = {
+		'lst':lst,
+		'ra':ra,
+		'dec':dec,
+		'solved_ra':ra+r.normal(0,0.01,n),
+		'solved_dec':dec+r.normal(0,0.01,n),
+		'lat':np.full(n,40.25),
+		'utc':np.full(n,1517713200.0),
+		'rejected':np.arange(n) == 3}
+	table['solved_ra'][5] = np.nan
+	text = export.block(table,'session one')
+	assert text.startswith('session one\n:NODA\n:EQUAT\n+40 15 00 2018 02 04\n')
+	data = mount_model.parse_tpoint(StringIO(text))
+	keep = ~table['rejected'] & np.isfinite(table['solved_ra'])
+	assert len(data['lst']) == keep.sum() == n-2
+	assert data['sessions'][0]['lat'] == 40.25
+	wrap = lambda a: (a+180) % 360 - 180
+	# rounding: 0.01s of RA, 0.1" of Dec, 0.01m of sidereal time
+	assert np.allclose(wrap(data['lst']*15-lst[keep]),0,atol=0.0026)
+	ra = data['lst']*15-data['ha_obs']
+	assert np.allclose(wrap(ra-table['solved_ra'][keep]),0,atol=0.15/3600)
+	assert np.allclose(data['dec_obs'],table['solved_dec'][keep],atol=0.1/3600)
+	assert np.allclose(data['dec_cmd'],dec[keep],atol=0.1/3600)
+
+def test_empty_session():
+	table = {'lst':np.zeros(1),'ra':np.zeros(1),'dec':np.zeros(1),
+		'solved_ra':np.full(1,np.nan),'solved_dec':np.full(1,np.nan),
+		'lat':np.zeros(1),'utc':np.zeros(1),'rejected':np.zeros(1,dtype=bool)}
+	assert export.block(table,'nothing') == ''
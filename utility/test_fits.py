@@ -0,0 +1,61 @@
+import os
+import pytest
+from utility import fits
+
+def _frame(path,cards,pixels=b'\x01\x02'*1440):
+	'''
+	Write a 16 bit FITS file with the given (key,value) cards after the
+	mandatory ones.
+	'''
+	header = [fits.format_card(k,v) for k,v in
+		[('SIMPLE',True),('BITPIX',16),('NAXIS',2),('NAXIS1',40),('NAXIS2',36)]+cards]
+	header.append('END'.ljust(fits.CARD))
+	text = ''.join(header)
+	with open(path,'wb') as f:
+		f.write(text+' '*(-len(text) % fits.BLOCK)+pixels)
+	return path
+
+RESERVED = [(key,0) for key in fits.SOLUTION_KEYS]
+
+def test_write_solution_overwrites_reserved_keys(tmpdir):
+	path = _frame(str(tmpdir.join('a.fits')),[('TP_KEY','s1')]+RESERVED)
+	size = os.path.getsize(path)
+	before = fits.pixel_hash(path)
+	fits.write_solution(path,{'ra':123.5,'dec':-12.25,'orientation':45.0,'pixscale':1.5})
+	header = fits.read_header(path)
+	assert header['TP_SOLVD'] == 1
+	assert header['TP_SRA'] == 123.5
+	assert header['TP_SDEC'] == -12.25
+	assert header['TP_SPA'] == 45.0
+	assert header['TP_SSCL'] == 1.5
+	assert header['TP_KEY'] == 's1'
+	assert os.path.getsize(path) == size
+	assert fits.pixel_hash(path) == before
+
+def test_write_solution_failure(tmpdir):
+	path = _frame(str(tmpdir.join('a.fits')),RESERVED)
+	fits.write_solution(path,None)
+	assert fits.read_header(path)['TP_SOLVD'] == -1
+
+def test_update_header_appends_after_end(tmpdir):
+	path = _frame(str(tmpdir.join('a.fits')),[('TP_KEY','s1')])
+	before = fits.pixel_hash(path)
+	fits.update_header(path,{'TP_SRA':10.0,'TP_SDEC':20.0})
+	header = fits.read_header(path)
+	assert (header['TP_SRA'],header['TP_SDEC'],header['TP_KEY']) == (10.0,20.0,'s1')
+	with open(path,'rb') as f:
+		assert fits.data_offset(f) == fits.BLOCK
+	assert fits.pixel_hash(path) == before
+
+def test_update_header_no_room(tmpdir):
+	# 5 mandatory cards + 30 + END fill the only header block
+	path = _frame(str(tmpdir.join('a.fits')),[('KEY%d' % i,i) for i in range(30)])
+	with open(path,'rb') as f:
+		original = f.read()
+	with pytest.raises(ValueError):
+		fits.update_header(path,{'TP_SRA':10.0})
+	# existing keys can still be changed
+	fits.update_header(path,{'KEY0':5})
+	assert fits.read_header(path)['KEY0'] == 5
+	with open(path,'rb') as f:
+		assert f.read()[fits.BLOCK:] == original[fits.BLOCK:]
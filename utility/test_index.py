@@ -0,0 +1,30 @@
+import ephem
+import numpy as np
+from utility import index
+
+HEADER = {'TP_KEY':'s1','TP_UTC':'2018-02-04T03:00:00.000','TP_LAT':40.0,'TP_LON':-84.0,
+	'TP_LST':6.0,'TP_AZ':10.0,'TP_EL':50.0}
+
+def _reported(ra,dec,date):
+	'''
+	What a perfect mount reports for a J2000 position: the same star in
+	coordinates of date (TP_RA in hours).
+	'''
+	e = ephem.Equatorial(ephem.Equatorial(np.radians(ra),np.radians(dec),epoch=ephem.J2000),epoch=ephem.Date(date))
+	return {'TP_RA':np.degrees(e.ra)/15,'TP_DEC':np.degrees(e.dec)}
+
+def test_residuals_are_taken_of_date():
+	header = dict(HEADER,**_reported(90.0,30.0,'2018/2/4 03:00'))
+	row = index.record('/f/s1_3.fits',header,{'ra':90.0,'dec':30.0})
+	assert abs(row['d_ra']) < 0.5
+	assert abs(row['d_dec']) < 0.5
+
+def test_residuals_wrap():
+	header = dict(HEADER,**_reported(359.999,0.0,'2018/2/4 03:00'))
+	row = index.record('/f/s1_3.fits',header,{'ra':0.001,'dec':0.0})
+	assert abs(row['d_ra']-7.2) < 0.5
+
+def test_residuals_without_time():
+	header = dict(HEADER,TP_UTC=None,**_reported(90.0,30.0,'2018/2/4 03:00'))
+	table = index.to_columns([index.record('/f/s1_3.fits',header,{'ra':90.0,'dec':30.0})])
+	assert np.isnan(table['d_ra'][0]) and np.isnan(table['d_dec'][0])
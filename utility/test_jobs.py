@@ -0,0 +1,50 @@
+from utility import jobs
+
+def _queue(tmpdir,*paths):
+	q = jobs.JobQueue(str(tmpdir.join('jobs.db')))
+	for path in paths:
+		q.add(path)
+	return q
+
+def test_add_once(tmpdir):
+	q = _queue(tmpdir)
+	assert q.add('/f/s1_1.fits')
+	assert not q.add('/f/s1_1.fits')
+	assert q.select(jobs.PENDING,'s1') == ['/f/s1_1.fits']
+
+def test_claim(tmpdir):
+	q = _queue(tmpdir,'s1_1.fits','s1_2.fits')
+	assert q.claim() == 's1_1.fits'
+	assert q.claim('s1_1.fits') is None
+	assert q.claim('s1_2.fits') == 's1_2.fits'
+	assert q.claim() is None
+	assert q.counts()[jobs.RUNNING] == 2
+
+def test_finish(tmpdir):
+	q = _queue(tmpdir,'s1_1.fits','s1_2.fits')
+	q.claim('s1_1.fits')
+	assert q.finish('s1_1.fits') == jobs.DONE
+	assert q.claim('s1_1.fits') is None
+	q.claim('s1_2.fits')
+	assert q.finish('s1_2.fits','no solution') == jobs.FAILED
+
+def test_transient_errors_retry_until_max_attempts(tmpdir):
+	q = _queue(tmpdir,'s1_1.fits')
+	for error in ('upload failed: 503','timed out'):
+		assert q.claim() == 's1_1.fits'
+		assert q.finish('s1_1.fits',error) == jobs.PENDING
+	q.claim()
+	assert q.finish('s1_1.fits','timed out') == jobs.FAILED
+
+def test_explicit_retry(tmpdir):
+	q = _queue(tmpdir,'s1_1.fits')
+	q.claim()
+	assert q.finish('s1_1.fits',RuntimeError('boom'),retry=True) == jobs.PENDING
+
+def test_recover(tmpdir):
+	q = _queue(tmpdir,'s1_1.fits','s1_2.fits')
+	q.claim('s1_1.fits')
+	# a new process after a crash
+	q = jobs.JobQueue(str(tmpdir.join('jobs.db')))
+	assert q.recover() == 1
+	assert q.state('s1_1.fits') == jobs.PENDING
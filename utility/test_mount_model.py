@@ -0,0 +1,120 @@
+from StringIO import StringIO
+import datetime
+import numpy as np
+from utility import mount_model, index
+
+TEXT = '''! comment
+Test session
+:NODA
+:EQUAT
+-33 30 00 2018 02 04
+01 00 00.00 +10 00 00.0  01 00 36.00 +10 00 10.0  02 00.00
+23 00 00.00 -00 30 00.0  23 00 00.00 +170 00 00.0  00 30.00
+END
+Second
++40 00 00 2018 02 05
+12 00 00.00 +45 00 00.0  12 00 00.00 +45 00 00.0  12 00.00  1
+END
+'''
+
+def test_parse_tpoint():
+	data = mount_model.parse_tpoint(StringIO(TEXT))
+	assert [s['caption'] for s in data['sessions']] == ['Test session','Second']
+	assert data['sessions'][0]['options'] == ['NODA','EQUAT']
+	assert data['sessions'][0]['lat'] == -33.5
+	assert list(data['session']) == [0,0,1]
+	assert list(data['lat']) == [-33.5,-33.5,40.0]
+	assert np.allclose(data['lst'],[2.0,0.5,12.0])
+	# one hour west of the meridian; the mount reads 36s of RA (9') later
+	assert np.allclose(data['ha_obs'][0],15.0)
+	assert np.allclose(data['ha_cmd'][0],15.0-0.15)
+	assert np.allclose(data['dec_cmd'][0],10+10/3600.0)
+	# "-00" carries the sign
+	assert np.allclose(data['dec_obs'][1],-0.5)
+
+def test_parse_tpoint_pier_side():
+	data = mount_model.parse_tpoint(StringIO(TEXT))
+	# dec beyond the pole: flipped, folded back over the pole
+	assert list(data['pier']) == [0,1,1]
+	assert np.allclose(data['dec_cmd'][1],10.0)
+	# and 12h away in RA: 0h30m - 11h
+	assert np.allclose(data['ha_cmd'][1],-10.5*15)
+
+def test_parse_tpoint_chunks():
+	whole = mount_model.parse_tpoint(StringIO(TEXT))
+	chunked = mount_model.parse_tpoint(StringIO(TEXT),chunk=1)
+	for key in ('ha_obs','dec_obs','ha_cmd','dec_cmd','lst','pier','lat','session'):
+		assert np.array_equal(whole[key],chunked[key])
+
+def test_robust_without_iterations():
+	data = mount_model.parse_tpoint(StringIO(TEXT))
+	model = mount_model.solve_tpoint(data,['IH','ID'],robust='tukey',iterations=0)
+	assert model['iterations'] == 0
+	assert len(model['rejected']) == 3
+
+def _index_table(ra,dec,utc):
+	'''
+	Index rows whose mount reported the J2000 ra/dec precessed to utc,
+	i.e. a perfect mount.
+	'''
+	import ephem
+	date = ephem.Date(datetime.datetime.utcfromtimestamp(utc))
+	now = [ephem.Equatorial(ephem.Equatorial(np.radians(r),np.radians(d),epoch=ephem.J2000),epoch=date)
+		for r,d in zip(ra,dec)]
+	n = len(ra)
+	return {
+		'path':np.array(['s1_%d.fits' % i for i in range(n)]),
+		'utc':np.full(n,utc),
+		'lat':np.full(n,40.0),
+		'lst':np.full(n,100.0),
+		'ra':np.degrees([e.ra for e in now]),
+		'dec':np.degrees([e.dec for e in now]),
+		'solved_ra':np.array(ra,dtype=float),
+		'solved_dec':np.array(dec,dtype=float)}
+
+def test_from_index_precesses_to_date():
+	ra = [0.0,90.0,180.0,270.0,45.0]
+	dec = [0.0,30.0,-20.0,60.0,80.0]
+	table = _index_table(ra,dec,1517713200.0)
+	# J2000 and 2018 of date differ by several arcminutes
+	assert np.abs(table['ra']-ra).max()*3600 > 300
+	data = mount_model.from_index(table)
+	dh = (data['ha_obs']-data['ha_cmd'])*np.cos(np.radians(data['dec_obs']))*3600
+	dd = (data['dec_obs']-data['dec_cmd'])*3600
+	assert np.abs(dh).max() < 1.0
+	assert np.abs(dd).max() < 1.0
+
+def test_from_index_drops_incomplete_frames():
+	table = _index_table([0.0,90.0,180.0],[0.0,30.0,-20.0],1517713200.0)
+	table['lst'][0] = np.nan
+	table['dec'][1] = np.nan
+	data = mount_model.from_index(table)
+	assert list(data['path']) == ['s1_2.fits']
+
+def test_recursive_model_skips_nan():
+	table = _index_table([0.0,90.0,180.0,270.0],[0.0,30.0,-20.0,60.0],1517713200.0)
+	data = mount_model.from_index(table)
+	data['ha_obs'][1] = np.nan
+	model = mount_model.RecursiveModel()
+	model.update(data)
+	assert model.n == 3
+	assert np.isfinite(model.values).all() and np.isfinite(model.P).all()
+
+def test_fit_index_flags_outliers(tmpdir):
+	r = np.random.RandomState(1)
+	n = 40
+	table = _index_table(r.uniform(0,360,n),r.uniform(-20,70,n),1517713200.0)
+	table['ra'] += r.normal(0,2,n)/3600/np.cos(np.radians(table['dec']))
+	table['dec'] += r.normal(0,2,n)/3600
+	table['dec'][7] += 0.1
+	rows = []
+	for i in range(n):
+		row = dict((k,v[i]) for k,v in table.items())
+		row.update(session='s1',frame=i,lon=-84.0,cmd_az=np.nan,cmd_el=np.nan,rejected=False)
+		index.residuals(row)
+		rows.append(row)
+	session_index = index.SessionIndex(str(tmpdir))
+	session_index.update(rows)
+	model = mount_model.fit_index(session_index,terms=['IH','ID'])
+	assert model['n'] == n
+	assert list(np.flatnonzero(session_index.load()['rejected'])) == [7]
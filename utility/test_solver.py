@@ -0,0 +1,39 @@
+import sqlite3
+from utility import solver
+from utility.bench import LocalClient
+
+P = {'astrometry':{'api':{},'solver':{'max_in_flight':2,'poll_min':0.01,'poll_max':0.05}}}
+
+class BrokenCache(object):
+	def __init__(self,fail_get=False):
+		self.fail_get = fail_get
+	def hash(self,path):
+		return path
+	def get(self,key):
+		if self.fail_get:
+			raise sqlite3.OperationalError('database is locked')
+		return None
+	def put(self,*args):
+		raise sqlite3.OperationalError('database is locked')
+
+def _solve(cache,paths):
+	manager = solver.SolveManager(P,client=LocalClient(),cache=cache)
+	try:
+		jobs = [manager.submit(path) for path in paths]
+		assert manager.join(10)
+		return jobs
+	finally:
+		manager.close()
+
+def test_solve():
+	jobs = _solve(False,['a.fits','b.fits','c.fits'])
+	assert [j.state for j in jobs] == [solver.SUCCESS]*3
+
+def test_cache_lookup_error_fails_job():
+	jobs = _solve(BrokenCache(fail_get=True),['a.fits','b.fits','c.fits'])
+	assert [j.state for j in jobs] == [solver.FAILURE]*3
+	assert all(j.done() and 'database is locked' in j.error for j in jobs)
+
+def test_cache_store_error_keeps_result():
+	jobs = _solve(BrokenCache(),['a.fits'])
+	assert jobs[0].state == solver.SUCCESS
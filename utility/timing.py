@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+from datetime import datetime
+
+'''
+Opt-in profiling.
+
+Off by default.  Turn it on with the TPOINT_PROFILE environment variable
+or a "profile" block in the config:
+
+	TPOINT_PROFILE=1         call timers only
+	TPOINT_PROFILE=cprofile  call timers plus cProfile of the whole command
+
+	"profile":{"enabled":true,"cprofile":false,"directory":"..."}
+
+Functions decorated with timed() and methods wrapped with instrument()
+record call count, total and worst time.  When disabled a timed function
+costs one flag check per call.  run() executes a command and writes the
+report (and cProfile stats) next to the session output.
+'''
+
+_enabled = False
+_lock = threading.Lock()
+# name -> [calls, total seconds, max seconds]
+_stats = {}
+
+def settings(P=None):
+	'''
+	Profiling settings from the environment, falling back to P['profile'].
+	'''
+	config = dict((P or {}).get('profile',{}))
+	env = os.environ.get('TPOINT_PROFILE','').strip().lower()
+	if env and env not in ('0','off','false','no'):
+		config['enabled'] = True
+		if env == 'cprofile':
+			config['cprofile'] = True
+	return config
+
+def configure(P=None):
+	'''
+	Enable the timers if settings(P) ask for it, returns the settings.
+	'''
+	global _enabled
+	config = settings(P)
+	_enabled = bool(config.get('enabled'))
+	return config
+
+def enabled():
+	return _enabled
+
+def reset():
+	with _lock:
+		_stats.clear()
+
+def add(name,seconds):
+	with _lock:
+		s = _stats.setdefault(name,[0,0.0,0.0])
+		s[0] += 1
+		s[1] += seconds
+		s[2] = max(s[2],seconds)
+
+def _wrap(f,name):
+	def wrapper(*args,**kwargs):
+		if not _enabled:
+			return f(*args,**kwargs)
+		start = time.time()
+		try:
+			return f(*args,**kwargs)
+		finally:
+			add(name,time.time()-start)
+	wrapper.__name__ = f.__name__
+	wrapper.__doc__ = f.__doc__
+	wrapper.__wrapped__ = f
+	return wrapper
+
+def timed(name=None):
+	'''
+	Decorator: time every call of the function under name (default its
+	module.function name).
+	'''
+	def decorate(f):
+		return _wrap(f,name or '%s.%s' % (f.__module__.split('.')[-1],f.__name__))
+	return decorate
+
+def instrument(obj,methods,prefix):
+	'''
+	Time the given methods of an object (a device or API client) as
+	prefix.method.  Does nothing unless profiling is enabled.
+	'''
+	if not _enabled:
+		return obj
+	for method in methods:
+		f = getattr(obj,method,None)
+		if f is not None and not hasattr(f,'__wrapped__'):
+			setattr(obj,method,_wrap(f,prefix+'.'+method))
+	return obj
+
+def summary():
+	'''
+	(name,calls,total,mean,max) rows, most total time first.
+	'''
+	with _lock:
+		rows = [(name,s[0],s[1],s[1]/s[0],s[2]) for name,s in _stats.items()]
+	return sorted(rows,key=lambda r: -r[2])
+
+def report(elapsed=None):
+	lines = ['%-32s %8s %10s %10s %10s' % ('call','calls','total s','mean s','max s')]
+	for name,calls,total,mean,worst in summary():
+		lines.append('%-32s %8d %10.3f %10.4f %10.4f' % (name,calls,total,mean,worst))
+	if elapsed is not None:
+		lines.append('%-32s %8s %10.3f' % ('(wall clock)','',elapsed))
+	return '\n'.join(lines)
+
+def run(name,f,P=None,directory=None):
+	'''
+	Run f() as the command called name.  With profiling enabled, write
+	profile_<name>_<time>.txt (and .prof with cProfile) to directory,
+	P['profile']['directory'] or the FITs directory.
+	'''
+	config = configure(P)
+	if not _enabled:
+		return f()
+	reset()
+	profiler = None
+	if config.get('cprofile'):
+		import cProfile
+		profiler = cProfile.Profile()
+	start = time.time()
+	try:
+		if profiler:
+			return profiler.runcall(f)
+		return f()
+	finally:
+		elapsed = time.time()-start
+		directory = directory or config.get('directory') or (P or {}).get('files',{}).get('fit_directory') or '.'
+		if not os.path.isdir(directory):
+			directory = '.'
+		base = os.path.join(directory,'profile_%s_%s' % (name,datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+		text = report(elapsed)
+		if profiler:
+			import pstats
+			from StringIO import StringIO
+			profiler.dump_stats(base+'.prof')
+			out = StringIO()
+			pstats.Stats(profiler,stream=out).sort_stats('cumulative').print_stats(30)
+			text += '\n\n'+out.getvalue()
+		with open(base+'.txt','w') as out:
+			out.write(text+'\n')
+		print "Profile written to",base+'.txt'
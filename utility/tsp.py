@@ -1,6 +1,7 @@
 import math
 import random
 import numpy as np
+import timing
 
 def distL2((x1,y1), (x2,y2)):
     """Compute the L2-norm (Euclidean) distance between two points.
@@ -251,6 +252,7 @@ def multistart_localsearch(k, n, D, report=None):
 
     return bestt, bestz
 
+@timing.timed('tsp.tsp')
 def tsp(coord=[(4,0),(5,6),(8,3),(4,4),(4,1),(4,10),(4,7),(6,8),(8,1)]):
     """Local search for the Travelling Saleman Problem: sample usage."""
     import sys
@@ -0,0 +1,157 @@
+import math
+from datetime import datetime, timedelta
+import ephem
+import numpy as np
+import geometry
+
+'''
+Precomputed visibility of sky positions over one night.
+
+For a site, a set of RA/Dec points and a time span, Visibility holds a
+(points x time steps) float32 table of az/el and a uint8 table of
+constraint flags, at one minute resolution by default.  Building it costs
+a few array operations (sidereal time advances linearly, precession is
+fixed for the night); after that "is point i usable at time t" is a
+single array lookup with no ephem calls.
+
+A flag bit is set for each constraint a point violates at a time step, so
+it is usable when its flags are zero.
+'''
+
+BELOW_LIMIT = 1    # below the minimum elevation
+NEAR_POLE = 2      # inside the pole buffer
+NEAR_MERIDIAN = 4  # inside the meridian buffer
+DAYLIGHT = 8       # sun above the twilight limit
+
+# sidereal days per solar day
+SIDEREAL_RATE = 1.00273790935
+
+def night(P,date=None,twilight=-12.0):
+	'''
+	Start and end (UTC datetimes) of the night following date (default
+	now), between the sun crossing twilight degrees altitude.
+	'''
+	obs = ephem.Observer()
+	obs.lat = np.radians(P['location']['lat'])
+	obs.lon = np.radians(P['location']['lon'])
+	obs.pressure = 0
+	obs.horizon = str(twilight)
+	obs.date = date or datetime.utcnow()
+	sun = ephem.Sun()
+	start = obs.next_setting(sun,use_center=True)
+	end = obs.next_rising(sun,start=start,use_center=True)
+	return start.datetime(),end.datetime()
+
+def meridian_distance(az,el):
+	'''
+	Great circle distance (deg) from az/el to the meridian at the same
+	elevation, as ScrubGridAzEl measures it.
+	'''
+	az = np.deg2rad(az)
+	el = np.deg2rad(el)
+	# nearer of the north (az 0) and south (az 180) branches
+	dlam = np.where(np.cos(az) >= 0,az,az-np.pi)
+	c = np.sin(el)**2+np.cos(el)**2*np.cos(dlam)
+	return np.rad2deg(np.arccos(np.clip(c,-1,1)))
+
+class Visibility(object):
+	'''
+	Az/el and constraint flags for points (J2000 ra/dec, deg) every step
+	minutes from start to end (UTC datetimes).  Limits come from P like
+	ScrubGridAzEl: P['survey']['masks']['include']['elevation'][0] and
+	P['survey']['buffers'].
+	'''
+	def __init__(self,P,ra,dec,start,end,step=1.0,twilight=-12.0):
+		self.start = start
+		self.step = float(step)
+		self.lat = P['location']['lat']
+		self.lon = P['location']['lon']
+		n = int((end-start).total_seconds()/60.0/self.step)+1
+		minutes = np.arange(n)*self.step
+		self.times = minutes
+		ra,dec = geometry.precess(start+(end-start)/2,np.atleast_1d(ra),np.atleast_1d(dec))
+		lst = geometry.compute_sidereal_time(self.lon,self.lat,0,start)*15+minutes*SIDEREAL_RATE/4.0
+		az,el = geometry.HaDec2AzEl_many(lst[None,:]-ra[:,None],dec[:,None],self.lat)
+		self.az = az.astype(np.float32)
+		self.el = el.astype(np.float32)
+		min_el = P['survey']['masks']['include']['elevation'][0]
+		buffers = P['survey']['buffers']
+		flags = np.where(el < min_el,BELOW_LIMIT,0).astype(np.uint8)
+		flags |= np.where(dec > 90-buffers['pole'],NEAR_POLE,0).astype(np.uint8)[:,None]
+		flags |= np.where(meridian_distance(az,el) < buffers['meridian'],NEAR_MERIDIAN,0).astype(np.uint8)
+		flags |= np.where(self._sun(n) > twilight,DAYLIGHT,0).astype(np.uint8)[None,:]
+		self.flags = flags
+
+	def _sun(self,n):
+		'''
+		Sun altitude (deg) at each step.
+		'''
+		obs = ephem.Observer()
+		obs.lat = np.radians(self.lat)
+		obs.lon = np.radians(self.lon)
+		obs.pressure = 0
+		sun = ephem.Sun()
+		alt = np.empty(n)
+		for k in range(n):
+			obs.date = self.start+timedelta(minutes=k*self.step)
+			sun.compute(obs)
+			alt[k] = np.degrees(sun.alt)
+		return alt
+
+	def index(self,t):
+		'''
+		Time step holding datetime t (or minutes since start).
+		'''
+		if isinstance(t,datetime):
+			t = (t-self.start).total_seconds()/60.0
+		k = int(math.floor(t/self.step))
+		if k < 0 or k >= len(self.times):
+			raise ValueError('time outside the table: %s' % t)
+		return k
+
+	def usable(self,i,t):
+		return self.flags[i,self.index(t)] == 0
+
+	def usable_at(self,t):
+		'''
+		Boolean array, one entry per point.
+		'''
+		return self.flags[:,self.index(t)] == 0
+
+	def azel(self,i,t):
+		k = self.index(t)
+		return self.az[i,k],self.el[i,k]
+
+	def window(self,i):
+		'''
+		First and last usable step of point i (minutes since start), or None.
+		'''
+		steps = np.flatnonzero(self.flags[i] == 0)
+		if not len(steps):
+			return None
+		return self.times[steps[0]],self.times[steps[-1]]
+
+	def save(self,path):
+		np.savez(path,az=self.az,el=self.el,flags=self.flags,times=self.times,
+			start=np.array(self.start.strftime('%Y-%m-%dT%H:%M:%S.%f')),
+			site=np.array([self.lat,self.lon,self.step]))
+
+	@classmethod
+	def load(cls,path):
+		self = cls.__new__(cls)
+		with np.load(path) as data:
+			self.az = data['az']
+			self.el = data['el']
+			self.flags = data['flags']
+			self.times = data['times']
+			self.start = datetime.strptime(str(data['start']),'%Y-%m-%dT%H:%M:%S.%f')
+			self.lat,self.lon,self.step = data['site']
+		return self
+
+def for_grid(P,az,el,start,end,step=1.0):
+	'''
+	Visibility of survey grid points, taken as the sky positions they
+	cover at start.
+	'''
+	ra,dec = zip(*[geometry.AzEl2RaDec(start,a,e,P['location']['lat'],P['location']['lon']) for a,e in zip(az,el)])
+	return Visibility(P,np.array(ra),np.array(dec),start,end,step)